@@ -0,0 +1,106 @@
+"""
+Benchmark comparing compression codecs on a sample of a source tree
+
+Reads up to the given number of MB of files under the source folder, then compresses and decompresses every sampled
+file with every codec and level. Prints compression and decompression throughput in MB/s of file data and the ratio.
+
+Usage: python benchmarks/bench_codecs.py src [sample size in MB] [codec:level,...]
+e.g. python benchmarks/bench_codecs.py /var/log 256 lz4:0,zstd:3,zstd:19,zstd-long:19,xz:6
+"""
+import io
+import sys
+import time
+
+from glacier_rsync.compression import CODECS
+from glacier_rsync.file_cache import FileCache
+from glacier_rsync.scanner import Scanner
+
+PART_SIZE = 8 * 1024 * 1024
+DEFAULT_SETTINGS = "lz4:0,zstd:1,zstd:3,zstd:19,zstd-long:19,xz:6"
+
+
+def sample_files(src, sample_size):
+	"""
+	:return: list of file contents, up to sample_size bytes in total
+	"""
+	samples = []
+	total = 0
+	for entry in Scanner(src, queue_size=1000):
+		try:
+			with open(entry.path, 'rb') as f:
+				data = f.read(sample_size - total)
+		except OSError:
+			continue
+		samples.append(data)
+		total += len(data)
+		if total >= sample_size:
+			break
+	return samples
+
+
+def compress(codec, level, data, buffer):
+	"""
+	Compress through FileCache like a backup does
+	"""
+	cache = FileCache(io.BytesIO(data), compression=codec, level=level)
+	output = io.BytesIO()
+	while True:
+		part = cache.read(PART_SIZE, buffer=buffer)
+		if part is None:
+			break
+		output.write(part.getbuffer())
+	return output.getvalue()
+
+
+def decompress(codec, data):
+	"""
+	Decompress through the stream writer of the codec like a restore does
+	"""
+	output = io.BytesIO()
+	writer = codec.writer(output)
+	writer.write(data)
+	writer.close()
+	return output.getvalue()
+
+
+def main():
+	if len(sys.argv) < 2:
+		print(__doc__)
+		return
+	src = sys.argv[1]
+	sample_size = (int(sys.argv[2]) if len(sys.argv) > 2 else 64) * 1024 * 1024
+	settings = [setting.split(":") for setting in (sys.argv[3] if len(sys.argv) > 3 else DEFAULT_SETTINGS).split(",")]
+
+	samples = sample_files(src, sample_size)
+	total = sum(len(sample) for sample in samples)
+	print(f"sampled {len(samples)} files, {total / 1048576:.1f} MB")
+	if total == 0:
+		return
+
+	buffer = bytearray(PART_SIZE)
+	print(f"{'codec':<10} {'level':>6} {'compress MB/s':>14} {'decompress MB/s':>16} {'ratio':>8}")
+	for name, level in settings:
+		codec = CODECS[name]
+		try:
+			codec.check_available()
+		except ValueError:
+			continue
+		compressed = []
+		start = time.perf_counter()
+		for sample in samples:
+			compressed.append(compress(codec, int(level), sample, buffer))
+		compress_seconds = time.perf_counter() - start
+
+		start = time.perf_counter()
+		for sample, data in zip(samples, compressed):
+			assert decompress(codec, data) == sample
+		decompress_seconds = time.perf_counter() - start
+
+		compressed_size = sum(len(data) for data in compressed)
+		print(
+			f"{name:<10} {level:>6} {total / 1048576 / compress_seconds:>14.1f} "
+			f"{total / 1048576 / decompress_seconds:>16.1f} {total / compressed_size:>8.2f}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,71 @@
+"""
+Benchmark for zstd compression settings
+
+Compresses the same data through FileCache with every combination of level and thread count and prints the throughput
+in MB/s of input and the compression ratio.
+
+Usage: python benchmarks/bench_compression.py [data size in MB] [levels] [thread counts]
+e.g. python benchmarks/bench_compression.py 256 1,3,9 0,4,auto
+"""
+import io
+import os
+import sys
+import time
+
+from glacier_rsync.argparser import ArgParser
+from glacier_rsync.compression import CODECS
+from glacier_rsync.file_cache import FileCache
+
+PART_SIZE = 8 * 1024 * 1024
+# random bytes mapped to 16 symbols, about 4 bits of entropy per byte and no long repeats, compresses roughly 2:1
+SYMBOLS = bytes(b"etaoinshrdlu \n.,"[i % 16] for i in range(256))
+
+
+def sample_data(size):
+	"""
+	Compressible data without repeated blocks, so that level and threads make a difference
+	"""
+	return os.urandom(size).translate(SYMBOLS)
+
+
+def bench(data, level, threads, repeat=3):
+	"""
+	:return: tuple(best time in seconds, compressed size)
+	"""
+	best = None
+	compressed_size = 0
+	buffer = bytearray(PART_SIZE)
+	for _ in range(repeat):
+		cache = FileCache(io.BytesIO(data), compression=CODECS["zstd"], level=level, threads=threads)
+		compressed_size = 0
+		start = time.perf_counter()
+		while True:
+			part = cache.read(PART_SIZE, buffer=buffer)
+			if part is None:
+				break
+			compressed_size += len(part)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, compressed_size
+
+
+def main():
+	size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+	levels = [ArgParser.compress_level(v) for v in (sys.argv[2] if len(sys.argv) > 2 else "1,3,9").split(",")]
+	thread_counts = [ArgParser.thread_count(v) for v in (sys.argv[3] if len(sys.argv) > 3 else "0,2,auto").split(",")]
+	try:
+		import zstandard  # noqa: F401
+	except ImportError:
+		print("zstandard is not installed")
+		return
+
+	data = sample_data(size_mb * 1024 * 1024)
+	print(f"{'level':>6} {'threads':>8} {'seconds':>10} {'MB/s':>10} {'ratio':>8}")
+	for level in levels:
+		for threads in thread_counts:
+			elapsed, compressed_size = bench(data, level, threads)
+			print(f"{level:>6} {threads:>8} {elapsed:>10.3f} {size_mb / elapsed:>10.1f} {len(data) / compressed_size:>8.2f}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,62 @@
+"""
+Micro-benchmark for FileCache part reads
+
+Reads a single part of increasing size and prints the time per MB. Throughput should stay flat as the part size grows,
+i.e. filling a part is linear in its size.
+
+Usage: python benchmarks/bench_file_cache.py [max part size in MB]
+"""
+import io
+import os
+import sys
+import time
+
+from glacier_rsync.compression import CODECS
+from glacier_rsync.file_cache import FileCache
+
+
+def sample_data(size):
+	"""
+	Half random, half repeated data so that zstd has something to compress
+	"""
+	block = os.urandom(64 * 1024) + b"glacier-rsync " * 4681
+	return (block * (size // len(block) + 1))[:size]
+
+
+def bench(data, part_size, compression, repeat=3):
+	best = None
+	for _ in range(repeat):
+		cache = FileCache(io.BytesIO(data), compression=CODECS["zstd"] if compression else None)
+		buffer = bytearray(part_size)
+		start = time.perf_counter()
+		part = cache.read(part_size, buffer=buffer)
+		elapsed = time.perf_counter() - start
+		assert part is not None
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+
+def main():
+	max_part_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+	modes = [False]
+	try:
+		import zstandard  # noqa: F401
+		modes.append(True)
+	except ImportError:
+		print("zstandard is not installed, only plain reads are measured")
+
+	print(f"{'mode':<6} {'part MB':>8} {'seconds':>10} {'ms/MB':>8} {'MB/s':>10}")
+	for compression in modes:
+		part_mb = 1
+		while part_mb <= max_part_mb:
+			part_size = part_mb * 1024 * 1024
+			# compressed parts need more input than the part size
+			data = sample_data(part_size * (8 if compression else 1))
+			elapsed = bench(data, part_size, compression)
+			mode = "zstd" if compression else "plain"
+			print(f"{mode:<6} {part_mb:>8} {elapsed:>10.4f} {elapsed * 1000 / part_mb:>8.3f} {part_mb / elapsed:>10.1f}")
+			part_mb *= 2
+
+
+if __name__ == "__main__":
+	main()
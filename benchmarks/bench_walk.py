@@ -0,0 +1,93 @@
+"""
+Benchmark of the directory walkers against os.walk
+
+Creates a synthetic tree of the given depth, fan out and number of files per directory, then times:
+- os.walk with an os.stat of every file, like the scan of older versions
+- Scanner.walk, single threaded with the stat of os.scandir
+- ParallelWalker with every worker count, ordered and unordered
+
+Local file systems answer from the page cache, so the walkers differ little. Create the tree on the file system to
+tune for, e.g. an NFS mount, to see the effect of the round trips.
+
+Usage: python benchmarks/bench_walk.py [depth] [fan out] [files per directory] [worker counts] [parent folder]
+e.g. python benchmarks/bench_walk.py 5 4 20 1,4,16,64 /mnt/nfs/tmp
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from glacier_rsync.scanner import Scanner
+from glacier_rsync.walker import ORDERED, UNORDERED, ParallelWalker
+
+
+def make_tree(root, depth, fan_out, files):
+	"""
+	:return: number of files created
+	"""
+	count = 0
+	for index in range(files):
+		with open(os.path.join(root, f"file{index}.txt"), "wb") as f:
+			f.write(b"x" * index)
+		count += 1
+	if depth > 0:
+		for index in range(fan_out):
+			directory = os.path.join(root, f"dir{index}")
+			os.mkdir(directory)
+			count += make_tree(directory, depth - 1, fan_out, files)
+	return count
+
+
+def os_walk(top):
+	"""
+	:return: generator of (path, size, mtime_ns)
+	"""
+	for root, _, names in os.walk(top):
+		for name in names:
+			path = os.path.join(root, name)
+			stat = os.stat(path)
+			yield path, stat.st_size, stat.st_mtime_ns
+
+
+def bench(walk, top, repeat=3):
+	"""
+	:return: tuple(best time in seconds, number of files)
+	"""
+	best = None
+	count = 0
+	for _ in range(repeat):
+		start = time.perf_counter()
+		count = sum(1 for _ in walk(top))
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, count
+
+
+def main():
+	depth = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+	fan_out = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+	files = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+	worker_counts = [int(v) for v in (sys.argv[4] if len(sys.argv) > 4 else "1,4,16").split(",")]
+	parent = sys.argv[5] if len(sys.argv) > 5 else None
+
+	top = tempfile.mkdtemp(prefix="grsync-bench-walk-", dir=parent)
+	try:
+		file_count = make_tree(top, depth, fan_out, files)
+		walkers = [("os.walk + stat", os_walk), ("Scanner.walk", Scanner.walk)]
+		for order in (ORDERED, UNORDERED):
+			for workers in worker_counts:
+				walkers.append((f"{order} x{workers}", ParallelWalker(workers, order=order).walk))
+
+		print(f"{file_count} files in {top}")
+		print(f"{'walker':>20} {'seconds':>10} {'files/s':>12}")
+		for name, walk in walkers:
+			elapsed, count = bench(walk, top)
+			assert count == file_count, f"{name} found {count} files"
+			print(f"{name:>20} {elapsed:>10.3f} {count / elapsed:>12.0f}")
+	finally:
+		shutil.rmtree(top)
+
+
+if __name__ == "__main__":
+	main()
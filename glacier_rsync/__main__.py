@@ -1,43 +1,64 @@
 # !/usr/bin/env python
 
 import logging
+import os
 import signal
 import sys
 
-from glacier_rsync.argparser import ArgParser
+from glacier_rsync.argparser import ArgParser, RestoreArgParser
 from glacier_rsync.backup_util import BackupUtil
+from glacier_rsync.restore_util import RestoreUtil
 
 FORCE_STOP_LIMIT = 3
-global stop_request_count
 
 
-def main():
-	args = ArgParser().get_args()
-	logging.getLogger(__name__)
-	logging.basicConfig(
-		format="%(asctime)s - %(module)s.%(funcName)s:%(lineno)d - %(levelname)s - %(message)s",
-		level=getattr(logging, args.log_level, None))
-
-	global stop_request_count
+def stop_handler(util):
+	"""
+	:param util: BackupUtil or RestoreUtil object
+	:return: signal handler asking util to stop, the FORCE_STOP_LIMIT'th signal exits immediately
+	"""
 	stop_request_count = 0
-	backup_util = BackupUtil(args)
 
 	def signal_handler(sig, frame):
-		global stop_request_count
+		nonlocal stop_request_count
 		stop_request_count += 1
 		if stop_request_count < FORCE_STOP_LIMIT:
-			logging.info(f"Stop is requested, grsync will exit when current upload is complete.")
+			logging.info(f"Stop is requested, grsync will exit when current transfers are complete.")
 			logging.info(f"Press ctrl+c {FORCE_STOP_LIMIT} times for force exit.")
-			backup_util.stop()
+			util.stop()
 		else:
+			# util is not closed, the interrupted main thread may hold the catalog lock. Every catalog write is its
+			# own sqlite transaction, an interrupted one is rolled back when the db is opened again.
 			logging.info(f"Force stop is requested. Exiting...")
-			backup_util.close()
-			sys.exit(0)
+			os._exit(0)  # do not wait for transfer workers
+
+	return signal_handler
+
+
+def main():
+	# grsync restore ..., "restore" is reserved as the first argument, a backup src named restore is given as ./restore
+	restore = sys.argv[1:2] == ["restore"]
+	if restore:
+		args = RestoreArgParser().get_args(sys.argv[2:])
+	else:
+		args = ArgParser().get_args()
+	logging.getLogger(__name__)
+	logging.basicConfig(
+		format="%(asctime)s - %(module)s.%(funcName)s:%(lineno)d - %(levelname)s - %(message)s",
+		level=getattr(logging, args.log_level, None))
+
+	if restore:
+		util = RestoreUtil(args)
+		run = util.restore
+	else:
+		util = BackupUtil(args)
+		run = util.backup
 
+	signal_handler = stop_handler(util)
 	signal.signal(signal.SIGINT, signal_handler)
 	signal.signal(signal.SIGTERM, signal_handler)
 
-	backup_util.backup()
+	run()
 
 
 if __name__ == "__main__":
@@ -1,10 +1,14 @@
 import argparse
 import logging
+import os
 
+from glacier_rsync.compression import CODECS, get_codec
 from glacier_rsync.release import __version__
+from glacier_rsync.walker import ORDERED, UNORDERED
 
 
 class ArgParser:
+	AUTO_LEVEL = "auto"
 
 	def __init__(self):
 		self.parser = argparse.ArgumentParser(
@@ -12,7 +16,173 @@ class ArgParser:
 			description="Rsync like glacier backup util",
 			formatter_class=argparse.ArgumentDefaultsHelpFormatter
 		)
+		self.add_common_arguments(self.parser)
 		self.parser.add_argument(
+			"--catalog-cache-size",
+			help="Memory budget in MB for loading the database into memory, db is queried per file if it is larger",
+			type=self.positive_int,
+			default=1024
+		)
+		self.parser.add_argument(
+			"--compress",
+			help=f"Compression codec: {', '.join(CODECS)}. true selects zstd, false disables compression",
+			type=self.codec_name,
+			default="false"
+		)
+		self.parser.add_argument(
+			"--compress-level",
+			help="Compression level, higher levels are slower and compress better. zstd: -7 to 22, lz4: 0 to 16, "
+				"xz: 0 to 9. 'auto' adjusts the level between files to the measured compression and upload rates. "
+				"None uses the default level of the codec: 3 for zstd, 0 for lz4, 6 for xz",
+			type=self.compress_level,
+			default=None,
+		)
+		self.parser.add_argument(
+			"--compress-threads",
+			help="Number of zstd threads compressing a single file, 'auto' for the number of cores. 0 compresses in "
+				"the reading thread",
+			type=self.thread_count,
+			default=0,
+		)
+		self.parser.add_argument(
+			"--compress-probe-size",
+			help="Compress this many bytes at the beginning of a file and upload it uncompressed if the compression "
+				"ratio is below --compress-min-ratio. 0 compresses every file",
+			type=int,
+			default=4194304,
+		)
+		self.parser.add_argument(
+			"--compress-min-ratio",
+			help="Minimum compression ratio for compressing a file",
+			type=float,
+			default=1.05,
+		)
+		self.parser.add_argument(
+			"--frame-size",
+			help="Compress every frame-size bytes of a file into an independent zstd frame, so frames can be compressed "
+				"and decompressed in parallel. 0 compresses a file into a single frame",
+			type=int,
+			default=0,
+		)
+		self.parser.add_argument(
+			"--compress-workers",
+			help="Number of processes compressing frames",
+			type=self.positive_int,
+			default=os.cpu_count() or 1,
+		)
+		self.parser.add_argument(
+			"--dictionary-size",
+			help="Train a zstd dictionary of this size in bytes from the small files of src and compress them with it. "
+				"0 disables the dictionary",
+			type=int,
+			default=0,
+		)
+		self.parser.add_argument(
+			"--dictionary-max-file-size",
+			help="Files up to this size in bytes are compressed with the dictionary",
+			type=self.positive_int,
+			default=131072,
+		)
+		self.parser.add_argument(
+			"--retrain-dictionary",
+			help="Train a new dictionary instead of reusing the one stored in the database",
+			type=self.str2bool,
+			default=False,
+		)
+		self.parser.add_argument(
+			"--part-size",
+			help="Part size for compression",
+			type=int,
+			default=1048576,
+		)
+		self.parser.add_argument(
+			"--single-upload-threshold",
+			help="Archives up to this size in bytes are uploaded with a single request instead of a multipart upload. "
+				"0 always uses multipart uploads",
+			type=int,
+			default=1048576,
+		)
+		self.parser.add_argument(
+			"--part-concurrency",
+			help="Number of parts of a single archive to upload at the same time",
+			type=self.positive_int,
+			default=1,
+		)
+		self.parser.add_argument(
+			"--jobs",
+			help="Number of files to back up at the same time",
+			type=self.positive_int,
+			default=1,
+		)
+		self.parser.add_argument(
+			"--scan-queue-size",
+			help="Maximum number of discovered files waiting to be processed",
+			type=self.positive_int,
+			default=10000,
+		)
+		self.parser.add_argument(
+			"--scan-workers",
+			help="Number of threads listing directories and stat'ing files. More workers help on network file systems",
+			type=self.positive_int,
+			default=1,
+		)
+		self.parser.add_argument(
+			"--scan-order",
+			help="ordered keeps the file order of a single threaded scan, unordered keeps all scan workers busy",
+			choices=[ORDERED, UNORDERED],
+			default=ORDERED,
+		)
+		self.parser.add_argument(
+			"--trust-dir-mtime",
+			help="Keep a snapshot of the source tree in the database and do not list directories or stat files of "
+				"directories whose modification time is unchanged. Files modified in place are not detected",
+			type=self.str2bool,
+			default=False,
+		)
+		self.parser.add_argument(
+			"--hash-workers",
+			help="Number of threads calculating checksums of parts while other parts are uploaded",
+			type=self.positive_int,
+			default=2,
+		)
+		self.add_retry_arguments(self.parser)
+		self.parser.add_argument(
+			"--pack-threshold",
+			help="Files smaller than this size in bytes are packed into tar bundles. 0 disables packing",
+			type=int,
+			default=0,
+		)
+		self.parser.add_argument(
+			"--bundle-size",
+			help="Target size of a tar bundle in bytes",
+			type=self.positive_int,
+			default=67108864,
+		)
+		self.parser.add_argument(
+			"--dedup",
+			help="Hash the content of files and reuse the archive of a file with the same content instead of uploading",
+			type=self.str2bool,
+			default=False,
+		)
+		self.parser.add_argument(
+			"--desc",
+			metavar="desc",
+			help="A description for the archive that will be stored in Amazon Glacier"
+		)
+		self.parser.add_argument(
+			"src",
+			metavar="src",
+			help="file or folder to generate archive from. restore as the first argument starts a restore, a folder "
+				"named restore is given as ./restore"
+		)
+
+	@staticmethod
+	def add_common_arguments(parser):
+		"""
+		Arguments shared by backup and restore
+		:param parser: argparse.ArgumentParser
+		"""
+		parser.add_argument(
 			"--loglevel",
 			dest="log_level",
 			type=str,
@@ -20,45 +190,54 @@ class ArgParser:
 			default="INFO",
 			help="log level"
 		)
-		self.parser.add_argument(
+		parser.add_argument(
 			"--db",
 			metavar="db",
 			help="database file to store sync info",
 			default="glacier.db"
 		)
-		self.parser.add_argument(
+		parser.add_argument(
 			"--vault",
 			metavar="vault",
 			help="Glacier vault name",
 			required=True
 		)
-		self.parser.add_argument(
+		parser.add_argument(
 			"--region",
 			metavar="region",
 			help="Glacier region name",
 			required=True
 		)
-		self.parser.add_argument(
-			"--compress",
-			help="Enable compression. Only zstd is supported",
-			type=self.str2bool,
-			default=False
+
+	@staticmethod
+	def add_retry_arguments(parser):
+		"""
+		Retry arguments shared by backup and restore
+		:param parser: argparse.ArgumentParser
+		"""
+		parser.add_argument(
+			"--max-throttling-retries",
+			help="Maximum number of retries of a request after throttling errors",
+			type=int,
+			default=10,
 		)
-		self.parser.add_argument(
-			"--part-size",
-			help="Part size for compression",
+		parser.add_argument(
+			"--max-server-retries",
+			help="Maximum number of retries of a request after server or connection errors",
 			type=int,
-			default=1048576,
+			default=5,
 		)
-		self.parser.add_argument(
-			"--desc",
-			metavar="desc",
-			help="A description for the archive that will be stored in Amazon Glacier"
+		parser.add_argument(
+			"--retry-base-delay",
+			help="Delay in seconds before the first retry, doubled for every retry",
+			type=float,
+			default=1.0,
 		)
-		self.parser.add_argument(
-			"src",
-			metavar="src",
-			help="file or folder to generate archive from"
+		parser.add_argument(
+			"--retry-max-delay",
+			help="Maximum delay in seconds between retries",
+			type=float,
+			default=60.0,
 		)
 
 	@staticmethod
@@ -72,5 +251,134 @@ class ArgParser:
 		else:
 			raise argparse.ArgumentTypeError('Boolean value expected.')
 
-	def get_args(self):
-		return self.parser.parse_args()
+	@staticmethod
+	def positive_int(v):
+		try:
+			value = int(v)
+		except ValueError:
+			raise argparse.ArgumentTypeError('Integer value expected.')
+		if value < 1:
+			raise argparse.ArgumentTypeError('Value must be at least 1.')
+		return value
+
+	@staticmethod
+	def codec_name(v):
+		"""
+		:return: codec name, None if compression is disabled
+		"""
+		if v in CODECS:
+			return v
+		try:
+			return "zstd" if ArgParser.str2bool(v) else None
+		except argparse.ArgumentTypeError:
+			raise argparse.ArgumentTypeError(f"Codec name or boolean value expected: {', '.join(CODECS)}.")
+
+	@staticmethod
+	def compress_level(v):
+		if v == ArgParser.AUTO_LEVEL:
+			return v
+		try:
+			return int(v)
+		except ValueError:
+			raise argparse.ArgumentTypeError('Integer value or auto expected.')
+
+	@staticmethod
+	def thread_count(v):
+		if v == "auto":
+			return os.cpu_count() or 1
+		try:
+			value = int(v)
+		except ValueError:
+			raise argparse.ArgumentTypeError('Integer value or auto expected.')
+		if value < 0:
+			raise argparse.ArgumentTypeError('Value must be at least 0.')
+		return value
+
+	@staticmethod
+	def power_of_two_megabytes(v):
+		value = ArgParser.positive_int(v)
+		megabytes, remainder = divmod(value, 1024 * 1024)
+		if remainder != 0 or megabytes & (megabytes - 1) != 0:
+			raise argparse.ArgumentTypeError('Value must be a power of two megabytes.')
+		return value
+
+	def get_args(self, args=None):
+		args = self.parser.parse_args(args)
+		self.check_compress_level(args)
+		return args
+
+	def check_compress_level(self, args):
+		"""
+		Levels are checked after parsing, the range depends on the --compress codec
+		"""
+		codec = get_codec(args.compress)
+		if codec is None or args.compress_level in (None, ArgParser.AUTO_LEVEL):
+			return
+		if not codec.min_level <= args.compress_level <= codec.max_level:
+			self.parser.error(
+				f"argument --compress-level: {codec.name} compression level must be between {codec.min_level} and "
+				f"{codec.max_level}")
+
+
+class RestoreArgParser(ArgParser):
+
+	def __init__(self):
+		self.parser = argparse.ArgumentParser(
+			f"grsync restore version {__version__}",
+			description="Restore files backed up by grsync",
+			formatter_class=argparse.ArgumentDefaultsHelpFormatter
+		)
+		self.add_common_arguments(self.parser)
+		self.parser.add_argument(
+			"--dest",
+			metavar="dest",
+			help="Folder to restore files into, files are restored under their full path",
+			required=True
+		)
+		self.parser.add_argument(
+			"--tier",
+			help="Glacier retrieval tier",
+			choices=["Expedited", "Standard", "Bulk"],
+			default="Standard"
+		)
+		self.parser.add_argument(
+			"--job-batch-size",
+			help="Maximum number of retrieval jobs waiting to complete at the same time",
+			type=self.positive_int,
+			default=100,
+		)
+		self.parser.add_argument(
+			"--poll-interval",
+			help="Seconds between checks for completed retrieval jobs",
+			type=self.positive_int,
+			default=900,
+		)
+		self.parser.add_argument(
+			"--download-concurrency",
+			help="Number of byte ranges of a job output to download at the same time",
+			type=self.positive_int,
+			default=4,
+		)
+		self.parser.add_argument(
+			"--chunk-size",
+			help="Size of a downloaded byte range, must be a power of two megabytes",
+			type=self.power_of_two_megabytes,
+			default=33554432,
+		)
+		self.parser.add_argument(
+			"--decompress-workers",
+			help="Number of threads decompressing frames of archives compressed with --frame-size",
+			type=self.positive_int,
+			default=os.cpu_count() or 1,
+		)
+		self.add_retry_arguments(self.parser)
+		self.parser.add_argument(
+			"path",
+			metavar="path",
+			nargs="?",
+			default="",
+			help="restore only the files under this path, all files if omitted"
+		)
+
+	def get_args(self, args=None):
+		return self.parser.parse_args(args)
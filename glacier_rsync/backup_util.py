@@ -1,14 +1,29 @@
-import binascii
-import hashlib
+import io
 import logging
+import multiprocessing
 import os
-import sqlite3
-import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 import boto3
-from botocore.exceptions import ClientError
-
-from glacier_rsync.file_cache import FileCache
+from botocore.exceptions import BotoCoreError, ClientError
+
+from glacier_rsync import dedup
+from glacier_rsync.argparser import ArgParser
+from glacier_rsync.catalog import Catalog
+from glacier_rsync.compression import PLAIN, get_codec
+from glacier_rsync.dictionary import load_dictionary, train_dictionary
+from glacier_rsync.file_cache import BufferPool, FileCache
+from glacier_rsync.level_controller import MAX_LEVEL, MIN_LEVEL, LevelController
+from glacier_rsync.packer import BundlePacker
+from glacier_rsync.probe import CompressionProbe
+from glacier_rsync.retry import CLIENT_CONFIG, RetryPolicy
+from glacier_rsync.scan_index import ScanIndex
+from glacier_rsync.scanner import Scanner
+from glacier_rsync.seekable import init_worker
+from glacier_rsync.stats import RunStats
+from glacier_rsync.tree_hash import ChecksumMismatchError, part_hashes, total_tree_hash, tree_hash
+from glacier_rsync.walker import ParallelWalker
 
 
 class BackupUtil:
@@ -16,35 +31,78 @@ class BackupUtil:
 		self.continue_running = True
 
 		self.src = args.src
-		self.compress = args.compress
+		self.codec = get_codec(args.compress)
+		self.compress_level = args.compress_level
+		self.level_controller = None
+		if self.codec is not None:
+			self.codec.check_available()
+			if self.compress_level is None:
+				self.compress_level = self.codec.default_level
+			if self.compress_level == ArgParser.AUTO_LEVEL:
+				self.level_controller = LevelController(
+					args.part_concurrency, min_level=max(MIN_LEVEL, self.codec.min_level),
+					max_level=min(MAX_LEVEL, self.codec.max_level))
+				self.compress_level = self.level_controller.level  # level of probes and bundle members
+			else:
+				self.codec.check_level(self.compress_level)
+		self.compress_threads = args.compress_threads
+		if self.codec is not None and self.compress_threads > 0 and not self.codec.supports_threads:
+			logging.warning(f"{self.codec.name} compresses in the reading thread, ignoring --compress-threads")
+			self.compress_threads = 0
+		self.frame_size = args.frame_size
+		self.compress_workers = args.compress_workers
+		self.compress_executor = None
+		if self.codec is not None and self.frame_size > 0:
+			# spawned workers do not inherit the threads and locks of this process
+			self.compress_executor = ProcessPoolExecutor(
+				max_workers=self.compress_workers, mp_context=multiprocessing.get_context("spawn"),
+				initializer=init_worker)
+		self.dictionary_size = args.dictionary_size
+		self.dictionary_max_file_size = args.dictionary_max_file_size
+		self.retrain_dictionary = args.retrain_dictionary
+		self.dictionary = None  # set by _prepare_dictionary
+		self.dict_id = None
+		self.dedup = args.dedup
+		if self.dedup:
+			dedup.check_available()
 		self.desc = args.desc
 		self.part_size = args.part_size
+		self.single_upload_threshold = args.single_upload_threshold
+		self.part_concurrency = args.part_concurrency
+		self.jobs = args.jobs
+		# buffers of single request uploads are reused between files, one per job and one for bundles of the main thread
+		self.whole_buffer_pool = BufferPool(self.jobs + 1, self.single_upload_threshold + 1)
+		self.scan_queue_size = args.scan_queue_size
+		self.trust_dir_mtime = args.trust_dir_mtime
+		self.scan_workers = args.scan_workers
+		if self.trust_dir_mtime and self.scan_workers > 1:
+			logging.warning("--scan-workers is ignored with --trust-dir-mtime, the snapshot walk is single threaded")
+		self.scan_order = args.scan_order
+		self.pack_threshold = args.pack_threshold
+		self.packer = None
+		if self.pack_threshold > 0:
+			self.packer = BundlePacker(
+				args.bundle_size, codec=self.codec, level=self.compress_level, min_ratio=args.compress_min_ratio)
 
 		self.vault = args.vault
 		self.region = args.region
 
-		self.glacier = boto3.client("glacier", region_name=self.region)
-
-		self.db_file = args.db
-		try:
-			self.conn = sqlite3.connect(self.db_file, isolation_level=None)
-			self.conn.execute('pragma journal_mode=wal')
-			logging.info("connected to glacier rsync db")
-		except sqlite3.Error as e:
-			logging.error(f"Cannot create glacier rsync db: {str(e)}")
-			raise ValueError(f"Cannot create glacier rsync db: {str(e)}")
-
-		cur = self.conn.cursor()
-		try:
-			cur.execute(
-				"create table if not exists sync_history (id integer primary key, path text, file_size integer, "
-				"mtime float, archive_id text, location text, checksum text, compression text, timestamp text);")
-			self.conn.commit()
-		except sqlite3.OperationalError as e:
-			logging.error(f"DB error. Cannot mark the file as backed up: {str(e)})")
-			sys.exit(2)
-		finally:
-			cur.close()
+		self.glacier = boto3.client("glacier", region_name=self.region, config=CLIENT_CONFIG)
+		# parts are hashed locally, botocore does not need to read the body again to hash it
+		self.glacier.meta.events.register_first(
+			"before-call.glacier.UploadMultipartPart", self._add_precomputed_sha256)
+		self.glacier.meta.events.register_first("before-call.glacier.UploadArchive", self._add_precomputed_sha256)
+		self.hash_executor = ThreadPoolExecutor(max_workers=args.hash_workers, thread_name_prefix="grsync-hash")
+		self.stats = RunStats()
+		self.retry = RetryPolicy(
+			args.max_throttling_retries, args.max_server_retries, args.retry_base_delay, args.retry_max_delay,
+			self.stats)
+
+		self.catalog = Catalog(args.db, cache_size=args.catalog_cache_size)
+		self.probe = None
+		if self.codec is not None and args.compress_probe_size > 0:
+			self.probe = CompressionProbe(
+				self.catalog, self.codec, args.compress_probe_size, args.compress_min_ratio, level=self.compress_level)
 		logging.debug("init is done")
 
 	def stop(self):
@@ -58,107 +116,253 @@ class BackupUtil:
 		"""
 		Close database connection
 		"""
-		self.conn.commit()
-		self.conn.close()
+		self.hash_executor.shutdown(wait=False)
+		if self.compress_executor is not None:
+			self.compress_executor.shutdown(wait=False)
+		self.catalog.close()
 
 	def backup(self):
 		"""
 		Interface function to find files and apply logic
 		"""
-		file_list = []
-		if os.path.isdir(self.src):  # if the source is a directory find all the files
-			for root, dirs, files in os.walk(self.src):
-				for file in files:
-					file_list.append(os.path.abspath(os.path.join(root, file)))
-		else:
-			file_list.append(self.src)  # if the source is a file just process it
+		self.catalog.load_cache()
+		if self.codec is not None and self.dictionary_size > 0:
+			self._prepare_dictionary()
+		walk = None  # single threaded Scanner.walk
+		if self.trust_dir_mtime:
+			walk = ScanIndex(self.catalog, self.stats).walk
+		elif self.scan_workers > 1:
+			walk = ParallelWalker(self.scan_workers, order=self.scan_order).walk
+		scanner = Scanner(self.src, queue_size=self.scan_queue_size, walk=walk)
+		with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+			in_flight = set()
+			for file_index, entry in enumerate(scanner):
+				if not self.continue_running:
+					logging.info(f"Exiting early...")
+					break
 
-		logging.info(f"number of files to backup: {len(file_list)}")
-		for file_index, file in enumerate(file_list):
-			if not self.continue_running:
-				logging.info(f"Exiting early...")
-				break
+				in_flight.add(executor.submit(self._process_file, entry, scanner.progress(file_index + 1)))
+				if len(in_flight) >= self.jobs:  # wait for a free slot before scheduling the next file
+					done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+					for finished in done:
+						finished.result()  # re-raise worker errors (e.g. db errors) in the main thread
+			scanner.stop()
 
-			is_backed_up, file_size, mtime = self._check_if_backed_up(file)
-			if not is_backed_up:  # True if already backed up
-				logging.info(f"{file_index + 1}/{len(file_list)} - {file} will be backed up")
+			done, _ = wait(in_flight)  # in-flight files are always completed, even if stop is requested
+			for finished in done:
+				finished.result()
 
-				part_size = self.decide_part_size(file_size)  # decide part size for each file
-				logging.debug(f"part size is {part_size}")
+		if self.packer is not None:  # files in the last bundle are already read, upload them even if stop is requested
+			bundle = self.packer.flush()
+			if bundle is not None:
+				self._backup_bundle(bundle)
 
-				file_object, compressed_file_object = self._compress(file)  # compress the file if specified
+		logging.info("All files are processed.")
+		self.stats.log_summary()
+		self.close()
 
-				desc = f'grsync|{file}|{file_size}|{mtime}|{self.desc}'
-				archive = self._backup(compressed_file_object, desc, part_size)
+	def _process_file(self, entry, progress):
+		"""
+		Check, compress, upload and mark a single file
+		:param entry: ScanEntry of the file, its stats are used for the check and the catalog row
+		:param progress: progress string for logging
+		"""
+		file, file_size, mtime_ns, mtime = entry.path, entry.size, entry.mtime_ns, entry.mtime
+		if self._check_if_backed_up(entry):  # True if already backed up
+			logging.info(f"{progress} - {file} is already backed up, skipping...")
+			self.stats.increment("files_skipped")
+			return
 
-				if archive is not None:
-					logging.info(f"{file} is backed up successfully")
-				else:
-					logging.error(f"Error backing up {file}")
+		if self.packer is not None and file_size < self.pack_threshold:
+			logging.info(f"{progress} - {file} will be packed into a bundle")
+			bundle = self.packer.add(file, file_size, mtime_ns, mtime)
+			self.stats.increment("files_packed")
+			if bundle is not None:
+				self._backup_bundle(bundle)
+			return
 
-				file_object.close()
-				self._mark_backed_up(file, archive)
-			else:
-				logging.info(f"{file_index + 1}/{len(file_list)} - {file} is already backed up, skipping...")
+		fingerprint = content_hashes = None
+		if self.dedup:
+			fingerprint = dedup.fingerprint(file, file_size)
+			if self.catalog.has_fingerprint(fingerprint):  # only candidates are hashed before the upload
+				self.stats.increment("dedup_candidates")
+				content_hashes = dedup.hash_file(file)
+				duplicate = self.catalog.find_archive(file_size, *content_hashes)
+				if duplicate is not None:
+					logging.info(f"{progress} - {file} has the same content as archive {duplicate[0]}, skipping upload")
+					self._mark_duplicate(entry, duplicate, content_hashes, fingerprint)
+					return
+
+		logging.info(f"{progress} - {file} will be backed up")
+
+		part_size = self.decide_part_size(file_size)  # decide part size for each file
+		logging.debug(f"part size is {part_size}")
+
+		codec = self.codec
+		dictionary = self.dictionary if file_size <= self.dictionary_max_file_size else None
+		if codec is not None and self.probe is not None and not self.probe.should_compress(file, dictionary):
+			logging.info(f"{file} is not compressible, uploading it without compression")
+			self.stats.increment("files_not_compressed")
+			codec = None
+		level = self.level_controller.level if self.level_controller is not None else self.compress_level
+		if codec is None:
+			dictionary = None
+		dict_id = self.dict_id if dictionary is not None else None
+		# compress the file if specified, other files are hashed while they are read for the upload
+		file_object, compressed_file_object = self._compress(
+			file, codec, level, dictionary=dictionary, hash_content=self.dedup and content_hashes is None)
+
+		desc = f'grsync|{file}|{file_size}|{mtime}|{self.desc}'
+		# parts compressed with another level or frame size cannot be mixed with the new ones
+		upload_key = (
+			file, file_size, mtime_ns, self._compression_name(codec, dict_id), level if codec is not None else None,
+			self._frame_size(dictionary) if codec is not None else None)
+		archive = self._backup(compressed_file_object, desc, part_size, upload_key=upload_key)
+
+		if archive is not None:
+			logging.info(f"{file} is backed up successfully")
+			self.stats.increment("files_backed_up")
+		else:
+			logging.error(f"Error backing up {file}")
+			self.stats.increment("files_failed")
+
+		file_object.close()
+		if archive is not None and self.dedup and content_hashes is None:
+			content_hashes = file_object.hexdigests()
+			if content_hashes is None:  # parts of a resumed upload are skipped without reading them
+				content_hashes = dedup.hash_file(file)
+		if archive is not None and codec is not None and self.level_controller is not None:
+			self.level_controller.record_compression(
+				level, file_size, compressed_file_object.bytes_read, compressed_file_object.read_seconds)
+		self._mark_backed_up(
+			entry, archive, self._compression_name(codec), frames=compressed_file_object.frames, dict_id=dict_id,
+			content_hashes=content_hashes, fingerprint=fingerprint)
+
+	def _mark_duplicate(self, entry, duplicate, content_hashes, fingerprint):
+		"""
+		Mark a file as backed up by the archive of a file with the same content
+		:param entry: ScanEntry of the file
+		:param duplicate: tuple(archive id, location, checksum, compression, timestamp, dict id) of the archive
+		:param content_hashes: tuple(fast hash, tree hash) of the file content
+		:param fingerprint: fingerprint of the file
+		"""
+		if self._is_modified(entry):  # the hashes may not belong to the scanned version
+			return
+		archive_id, location, checksum, compression, timestamp, dict_id = duplicate
+		self.catalog.mark_backed_up(
+			entry.path, entry.size, entry.mtime_ns, entry.mtime, archive_id, location, checksum, compression, timestamp,
+			dict_id=dict_id, content_hash=content_hashes[0], tree_hash=content_hashes[1], fingerprint=fingerprint)
+		self.stats.increment("files_deduplicated")
+		self.stats.increment("bytes_deduplicated", entry.size)
+
+	def _prepare_dictionary(self):
+		"""
+		Load the dictionary of the previous runs or train and upload a new one
+		The dictionary is uploaded as its own archive before any file compressed with it, so a restore never depends on
+		a dictionary that only exists in the local database.
+		"""
+		if not self.codec.supports_dictionary:
+			logging.warning(f"{self.codec.name} does not support dictionaries, files are compressed without one")
+			return
+		stored = None if self.retrain_dictionary else self.catalog.get_dictionary()
+		if stored is not None:
+			dict_id, data = stored
+			logging.info(f"using compression dictionary {dict_id} from the database")
+		else:
+			trained = train_dictionary(self.src, self.dictionary_size, self.dictionary_max_file_size)
+			if trained is None:
+				return
+			dict_id, data = trained.dict_id(), trained.as_bytes()
+			desc = f'grsync-dictionary|{dict_id}|{len(data)}|{self.desc}'
+			archive = self._backup(FileCache(io.BytesIO(data)), desc, self.decide_part_size(len(data)))
+			if archive is None:
+				logging.error("Error backing up the compression dictionary, files are compressed without it")
+				return
+			self.catalog.add_dictionary(
+				dict_id, archive['archiveId'], archive['location'], archive['checksum'], data,
+				archive['ResponseMetadata']['HTTPHeaders']['date'])
+			logging.info(f"compression dictionary {dict_id} of {len(data)} bytes is backed up")
+		self.dictionary = load_dictionary(data)
+		self.dict_id = dict_id
+		if self.packer is not None:
+			self.packer.dictionary = self.dictionary
+			self.packer.dict_id = dict_id
+			self.packer.dictionary_max_file_size = self.dictionary_max_file_size
+
+	def _backup_bundle(self, bundle):
+		"""
+		Upload a finalized bundle as a single archive and mark all of its members
+		:param bundle: Bundle object
+		"""
+		logging.info(f"uploading a bundle of {len(bundle.members)} files, {bundle.archive_size} bytes")
+		part_size = self.decide_part_size(bundle.archive_size)
+		desc = f'grsync-bundle|{len(bundle.members)}|{bundle.archive_size}|{self.desc}'
+		archive = self._backup(FileCache(bundle.file_object), desc, part_size)
+		bundle.close()
 
-		logging.info("All files are processed.")
-		self.close()
+		if archive is None:
+			logging.error(f"Error backing up a bundle of {len(bundle.members)} files")
+			self.stats.increment("files_failed", len(bundle.members))
+			return
+		self.catalog.mark_bundle_backed_up(
+			archive['archiveId'], archive['location'], archive['checksum'], bundle.archive_size, bundle.members,
+			archive['ResponseMetadata']['HTTPHeaders']['date'])
+		self.stats.increment("bundles_backed_up")
+		self.stats.increment("files_backed_up", len(bundle.members))
 
-	def _check_if_backed_up(self, path):
+	def _check_if_backed_up(self, entry):
 		"""
 		Check if file is already backed up
-		:param path: full file path
+		:param entry: ScanEntry of the file
 		:return: True if file is backed up, False if file is not backed up
 		"""
-		file_size, mtime = self.__get_stats(path)  # file size and mtime should match. if not it will be backed up again
-		cur = self.conn.cursor()
-		try:
-			cur.execute(
-				f"select * from sync_history where path='{path}' and file_size={file_size} and mtime={mtime}")
-			rows = cur.fetchall()
-		except sqlite3.OperationalError as e:
-			logging.error(f"DB error. Cannot mark the file as backed up: {str(e)})")
-			sys.exit(3)
-		finally:
-			cur.close()
-		return len(rows) > 0, file_size, mtime
+		# file size and mtime should match. if not it will be backed up again
+		return self.catalog.is_backed_up(entry.path, entry.size, entry.mtime_ns, entry.mtime)
 
-	def _compress(self, file):
+	def _compress(self, file, codec, level, dictionary=None, hash_content=False):
 		"""
 		Compress given file with given algorithm
 		:param file: input file path
+		:param codec: Codec object, None for no compression
+		:param level: compression level
+		:param dictionary: compression dictionary, files compressed with a dictionary are small and not split into frames
+		:param hash_content: hash the file content while it is read, the file object is a dedup.HashingReader
 		:return: compressed file path. If no compression is selected, the same file path
 		"""
-
 		file_object = open(file, 'rb')
-		compression = False
-
-		if self.compress:
-			try:
-				import zstandard as zstd
-			except ImportError:
-				msg = "cannot import zstd. Please install `zstandard' package!"
-				logging.error(msg)
-				raise ValueError(msg)
-			compression = True
+		if hash_content:
+			file_object = dedup.HashingReader(file_object)
+		return file_object, FileCache(
+			file_object, compression=codec, level=level, threads=self.compress_threads,
+			frame_size=self._frame_size(dictionary), executor=self.compress_executor, window=self.compress_workers,
+			dictionary=dictionary)
+
+	def _frame_size(self, dictionary):
+		"""
+		:return: frame size of a compressed file, files compressed with a dictionary are a single frame
+		"""
+		return self.frame_size if dictionary is None else 0
 
-		return file_object, FileCache(file_object, compression=compression)
+	@staticmethod
+	def _compression_name(codec, dict_id=None):
+		"""
+		:param codec: Codec object of the file, None if the file is not compressed
+		:param dict_id: id of the dictionary of the file, part of the name of resumable uploads only
+		:return: name of the compression algorithm stored in db
+		"""
+		if codec is None:
+			return PLAIN
+		return codec.name if dict_id is None else f"{codec.name}:{dict_id}"
 
-	def calculate_tree_hash(self, part, part_size):
+	@staticmethod
+	def calculate_tree_hash(part, part_size):
 		"""
 		Calculate hash of single part
 		:param part: data chunk
 		:param part_size: size of the chunk
 		:return: calculated hash
 		"""
-		checksums = []
-		upper_bound = min(len(part), part_size)
-		step = 1024 * 1024  # 1 MB
-		for chunk_pos in range(0, upper_bound, step):
-			chunk = part[chunk_pos: chunk_pos + step]
-			checksums.append(hashlib.sha256(chunk).hexdigest())
-			del chunk
-		return self.calculate_total_tree_hash(checksums)
+		return tree_hash(memoryview(part)[:part_size])
 
 	@staticmethod
 	def calculate_total_tree_hash(checksums):
@@ -167,111 +371,312 @@ class BackupUtil:
 		:param checksums: list(checksum) -> a list of checksum
 		:return: total calculated hash
 		"""
-		tree = checksums[:]
-		while len(tree) > 1:
-			parent = []
-			for i in range(0, len(tree), 2):
-				if i < len(tree) - 1:
-					part1 = binascii.unhexlify(tree[i])
-					part2 = binascii.unhexlify(tree[i + 1])
-					parent.append(hashlib.sha256(part1 + part2).hexdigest())
-				else:
-					parent.append(tree[i])
-			tree = parent
-		return tree[0]
-
-	def _backup(self, src_file_object, description, part_size):
+		return total_tree_hash(checksums)
+
+	def _backup(self, src_file_object, description, part_size, upload_key=None):
 		"""
 		Send the file to glacier
 		:param src_file_object: FileCache object
 		:param description: Archive description including grsync meta
 		:param part_size: Part size for multipart upload
+		:param upload_key: tuple(path, file size, mtime_ns, compression, compression level, frame size) to persist the
+			upload for resuming, None if the upload is not resumable
 		:return: archive information
 		"""
 		if src_file_object is None:  # only happens if unsupported compression algorithm
 			return None
+		upload_id = None
+		whole_buffer = None
 		try:
-			response = self.glacier.initiate_multipart_upload(
-				vaultName=self.vault,
-				partSize=str(part_size),
-				archiveDescription=description
-			)
-			upload_id = response['uploadId']
-
-			byte_pos = 0
-			list_of_checksums = []
-			while True:
-				chunk = src_file_object.read(part_size)
-				if chunk is None:
-					break
-				range_header = "bytes {}-{}/*".format(
-					byte_pos, byte_pos + len(chunk) - 1
-				)
-				byte_pos += len(chunk)
-				response = self.glacier.upload_multipart_part(
+			upload_id, completed_parts = self._resume_upload(upload_key, part_size)
+			if upload_id is None and self.single_upload_threshold > 0:
+				# a longer stream keeps the bytes read ahead in the buffer, it is released after the upload
+				whole_buffer = self.whole_buffer_pool.acquire()
+				whole = src_file_object.read_whole(self.single_upload_threshold, buffer=whole_buffer)
+				if whole is not None:
+					return self._upload_archive(whole, description, part_size)
+			if upload_id is None:
+				response = self.retry.call(
+					self.glacier.initiate_multipart_upload,
 					vaultName=self.vault,
-					uploadId=upload_id,
-					range=range_header,
-					body=chunk,
+					partSize=str(part_size),
+					archiveDescription=description
 				)
-				checksum = response["checksum"]
-				list_of_checksums.append(checksum)
+				upload_id = response['uploadId']
+				if upload_key is not None:
+					self.catalog.start_upload(*upload_key, upload_id, part_size)
 
-			total_tree_hash = self.calculate_total_tree_hash(list_of_checksums)
-			archive = self.glacier.complete_multipart_upload(
+			byte_pos = 0
+			part_futures = []
+			# part buffers are reused, one part is read and hashed while part_concurrency parts are uploaded
+			buffer_pool = BufferPool(self.part_concurrency + 1, part_size)
+			with ThreadPoolExecutor(max_workers=self.part_concurrency) as executor:
+				in_flight = set()
+				try:
+					while True:
+						part_index = len(part_futures)
+						completed_part = completed_parts.get(part_index)
+						if completed_part is not None and not src_file_object.compression:
+							# uncompressed data of an unchanged file is the same, no need to read it again
+							_, range_end, checksum = completed_part
+							src_file_object.skip(range_end + 1 - byte_pos)
+							byte_pos = range_end + 1
+							part_futures.append(self._completed_future(checksum))
+							continue
+
+						buffer = buffer_pool.acquire()
+						chunk = src_file_object.read(part_size, buffer=buffer)
+						if chunk is None:
+							buffer_pool.release(buffer)
+							break
+						range_start, range_end = byte_pos, byte_pos + len(chunk) - 1
+						byte_pos += len(chunk)
+
+						hash_future = self.hash_executor.submit(part_hashes, chunk.getbuffer())
+						if completed_part is not None and completed_part[:2] == (range_start, range_end) and \
+							hash_future.result()[0] == completed_part[2]:
+							buffer_pool.release(buffer)  # compressed part is identical to the uploaded one
+							part_futures.append(self._completed_future(completed_part[2]))
+							continue
+
+						future = executor.submit(
+							self._upload_part, upload_id, part_index, range_start, range_end, chunk, hash_future)
+						future.add_done_callback(lambda _, released=buffer: buffer_pool.release(released))
+						part_futures.append(future)  # keep part order for the total tree hash
+						in_flight.add(future)
+						del chunk
+
+						if len(in_flight) > self.part_concurrency:  # bound the number of parts held in memory
+							done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+							for finished in done:
+								finished.result()  # re-raise upload errors as early as possible
+				except BaseException:
+					for future in in_flight:
+						future.cancel()  # queued parts of a failed upload are not sent
+					raise
+
+			list_of_checksums = [future.result() for future in part_futures]
+			local_tree_hash = total_tree_hash(list_of_checksums)  # part checksums are verified against glacier
+			archive = self.retry.call(
+				self.glacier.complete_multipart_upload,
 				vaultName=self.vault,
 				uploadId=upload_id,
 				archiveSize=str(byte_pos),
-				checksum=total_tree_hash,
+				checksum=local_tree_hash,
 			)
-		except ClientError as e:
+			self.catalog.finish_upload(upload_id)
+			upload_id = None
+			if archive["checksum"] != local_tree_hash:
+				raise ChecksumMismatchError(
+					f"archive {archive['archiveId']} checksum {archive['checksum']} does not match the local "
+					f"checksum {local_tree_hash}")
+		except (ClientError, BotoCoreError, ChecksumMismatchError) as e:
 			logging.error(e)
+			if upload_id is not None:  # retries are exhausted, do not leave an orphan upload behind
+				self._abort_upload(upload_id)
 			return None
+		finally:
+			if whole_buffer is not None:
+				self.whole_buffer_pool.release(whole_buffer)
 
 		# Return dictionary of archive information
 		return archive
 
-	def _mark_backed_up(self, path, archive):
+	def _upload_archive(self, part, description, part_size):
+		"""
+		Upload a small archive with a single request
+		:param part: Part object of the whole archive
+		:param description: Archive description including grsync meta
+		:param part_size: part size the archive would be uploaded with in a multipart upload
+		:return: archive information
+		"""
+		local_tree_hash, part.sha256 = part_hashes(part.getbuffer())
+
+		def send():
+			part.seek(0)  # body is consumed by a failed attempt
+			return self.glacier.upload_archive(
+				vaultName=self.vault,
+				archiveDescription=description,
+				checksum=local_tree_hash,
+				body=part,
+			)
+
+		archive = self.retry.call(send)
+		if archive["checksum"] != local_tree_hash:
+			raise ChecksumMismatchError(
+				f"archive {archive['archiveId']} checksum {archive['checksum']} does not match the local "
+				f"checksum {local_tree_hash}")
+		self.stats.increment("bytes_uploaded", len(part))
+		self.stats.increment("single_request_uploads")
+		# a multipart upload needs an initiate and a complete request besides its parts
+		self.stats.increment("api_calls_saved", 1 + -(-len(part) // part_size))
+		return archive
+
+	def _resume_upload(self, upload_key, part_size):
+		"""
+		Find an unfinished upload of the same file and reconcile its parts with glacier
+		An unfinished upload of a changed file is aborted.
+		:param upload_key: tuple(path, file size, mtime_ns, compression, compression level, frame size)
+		:param part_size: part size of the new upload
+		:return: tuple(upload id, dict(part index -> (range start, range end, checksum))), upload id is None if there
+			is nothing to resume
+		"""
+		if upload_key is None:
+			return None, {}
+		upload = self.catalog.get_upload(upload_key[0])
+		if upload is None:
+			return None, {}
+
+		upload_id, *upload_settings, upload_part_size = upload
+		if (*upload_settings, upload_part_size) != (*upload_key[1:], part_size):
+			logging.info(
+				f"{upload_key[0]} or its compression settings changed since the last upload attempt, aborting the old upload")
+			self._abort_upload(upload_id)
+			return None, {}
+
+		uploaded_parts = {}
+		try:
+			marker = None
+			while True:
+				kwargs = {"marker": marker} if marker is not None else {}
+				response = self.retry.call(
+					self.glacier.list_parts, vaultName=self.vault, uploadId=upload_id, **kwargs)
+				for part in response["Parts"]:
+					range_start, range_end = (int(pos) for pos in part["RangeInBytes"].split("-"))
+					uploaded_parts[(range_start, range_end)] = part["SHA256TreeHash"]
+				marker = response.get("Marker")
+				if not marker:
+					break
+		except (ClientError, BotoCoreError) as e:
+			logging.info(f"cannot resume the upload of {upload_key[0]}, starting over: {str(e)}")
+			self.catalog.finish_upload(upload_id)
+			return None, {}
+
+		completed_parts = {
+			part_index: (range_start, range_end, checksum)
+			for part_index, (range_start, range_end, checksum) in self.catalog.get_upload_parts(upload_id).items()
+			if uploaded_parts.get((range_start, range_end)) == checksum
+		}
+		logging.info(f"resuming the upload of {upload_key[0]}, {len(completed_parts)} parts are already uploaded")
+		return upload_id, completed_parts
+
+	def _abort_upload(self, upload_id):
+		"""
+		Abort a multipart upload and forget about it
+		:param upload_id: multipart upload id
+		"""
+		try:
+			self.retry.call(self.glacier.abort_multipart_upload, vaultName=self.vault, uploadId=upload_id)
+		except (ClientError, BotoCoreError) as e:
+			# upload is kept in db, it is resumed or aborted in the next run
+			logging.warning(f"cannot abort upload {upload_id}: {str(e)}")
+			return
+		self.stats.increment("uploads_aborted")
+		self.catalog.finish_upload(upload_id)
+
+	@staticmethod
+	def _add_precomputed_sha256(params, **kwargs):
+		"""
+		botocore event handler, sets the sha256 header of a part from the locally calculated hash
+		botocore calculates the hash only if the header is missing.
+		:param params: request dict
+		"""
+		sha256 = getattr(params["body"], "sha256", None)
+		if sha256 is not None:
+			params["headers"]["x-amz-content-sha256"] = sha256
+
+	@staticmethod
+	def _completed_future(checksum):
+		"""
+		:param checksum: checksum of an already uploaded part
+		:return: a done future with the checksum of the part
+		"""
+		future = Future()
+		future.set_result(checksum)
+		return future
+
+	def _upload_part(self, upload_id, part_index, range_start, range_end, chunk, hash_future):
+		"""
+		Upload a single part of a multipart upload and persist it for resuming
+		:param upload_id: multipart upload id
+		:param part_index: index of the part in the archive
+		:param range_start: first byte of the part in the archive
+		:param range_end: last byte of the part in the archive
+		:param chunk: Part object
+		:param hash_future: future of the local (tree hash, sha256) of the part
+		:return: checksum of the part
+		"""
+		local_tree_hash, chunk.sha256 = hash_future.result()
+
+		def send():
+			chunk.seek(0)  # body is consumed by a failed attempt
+			return self.glacier.upload_multipart_part(
+				vaultName=self.vault,
+				uploadId=upload_id,
+				range=f"bytes {range_start}-{range_end}/*",
+				body=chunk,
+				checksum=local_tree_hash,
+			)
+
+		upload_start = time.monotonic()
+		response = self.retry.call(send)
+		if self.level_controller is not None:
+			self.level_controller.record_upload(len(chunk), time.monotonic() - upload_start)
+		checksum = response["checksum"]
+		if checksum != local_tree_hash:
+			raise ChecksumMismatchError(
+				f"part {range_start}-{range_end} checksum {checksum} does not match the local checksum {local_tree_hash}")
+		self.stats.increment("bytes_uploaded", len(chunk))
+		self.catalog.add_upload_part(upload_id, part_index, range_start, range_end, checksum)
+		return checksum
+
+	def _mark_backed_up(
+		self, entry, archive, compression, frames=None, dict_id=None, content_hashes=None, fingerprint=None):
 		"""
 		Mark the given file as archived in db with associated information
-		:param path: absolute path of the file
+		The file is marked with its stats from the scan. An archive of a file modified since the scan may be torn, it is
+		still recorded so that it can be found and deleted, but without content hashes. The current stats of the file do
+		not match the row, so it is backed up again in the next run.
+		:param entry: ScanEntry of the file
 		:param archive: glacier archive information
+		:param compression: name of the compression algorithm of the archive
+		:param frames: list of Frame if the archive is made of independent frames
+		:param dict_id: id of the dictionary the archive is compressed with
+		:param content_hashes: tuple(fast hash, tree hash) of the file content, None if deduplication is disabled
+		:param fingerprint: fingerprint of the file, None if deduplication is disabled
 		"""
 		if archive is None:
-			logging.error(f"{path} cannot be backed up")
+			logging.error(f"{entry.path} cannot be backed up")
 			return
+		if self._is_modified(entry):
+			content_hashes, fingerprint = None, None  # the hashes may not belong to the archived version
 		archive_id = archive['archiveId']
 		location = archive['location']
 		checksum = archive['checksum']
 		timestamp = archive['ResponseMetadata']['HTTPHeaders']['date']
-		compression = "plain"
-		if self.compress:
-			compression = "zstd"
+		content_hash, content_tree_hash = content_hashes if content_hashes is not None else (None, None)
 
-		file_size, mtime = self.__get_stats(path)
-		cur = self.conn.cursor()
-		try:
-			cur.execute(
-				f"insert into sync_history "
-				f"(path, file_size, mtime, archive_id, location, checksum, compression, timestamp) "
-				f"values ('{path}', {file_size}, {mtime}, '{archive_id}', '{location}', "
-				f"'{checksum}', '{compression}', '{timestamp}')"
-			)
-			self.conn.commit()
-		except sqlite3.OperationalError as e:
-			logging.error(f"DB error. Cannot mark the file as backed up: {str(e)})")
-			sys.exit(1)  # cannot continue if cannot mark
-		finally:
-			cur.close()
+		self.catalog.mark_backed_up(
+			entry.path, entry.size, entry.mtime_ns, entry.mtime, archive_id, location, checksum, compression, timestamp,
+			frames=frames, dict_id=dict_id, content_hash=content_hash, tree_hash=content_tree_hash,
+			fingerprint=fingerprint)
 
-	@staticmethod
-	def __get_stats(path):
+	def _is_modified(self, entry):
 		"""
-		Get the stats of given file
-		:param path: absolute path of the file
-		:return: tuple(file size, modified time)
+		Compare the current stats of a file with its stats from the scan
+		A file modified while it is read may be uploaded torn, it is backed up again in the next run.
+		:param entry: ScanEntry of the file
+		:return: True if the file is modified or removed since the scan
 		"""
-		return os.path.getsize(path), os.path.getmtime(path)
+		try:
+			stat = os.stat(entry.path)
+			is_modified = (stat.st_size, stat.st_mtime_ns) != (entry.size, entry.mtime_ns)
+		except OSError:
+			is_modified = True
+		if is_modified:
+			logging.warning(f"{entry.path} is modified during the backup, it will be backed up in the next run")
+			self.stats.increment("files_modified_during_backup")
+		return is_modified
 
 	def decide_part_size(self, file_size):
 		"""
@@ -0,0 +1,708 @@
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+from glacier_rsync.seekable import Frame
+
+# schema migrations, MIGRATIONS[n] brings the db from version n to version n + 1
+MIGRATIONS = [
+	(
+		"create table if not exists sync_history (id integer primary key, path text, file_size integer, "
+		"mtime float, archive_id text, location text, checksum text, compression text, timestamp text)",
+	),
+	(
+		# exact integer modification time, rows created before this version have null and are upgraded lazily
+		"alter table sync_history add column mtime_ns integer",
+		"create index sync_history_lookup on sync_history (path, file_size, mtime_ns)",
+		"create index sync_history_archive_id on sync_history (archive_id)",
+	),
+	(
+		# unfinished multipart uploads and their completed parts, used to resume interrupted uploads
+		"create table upload_state (upload_id text primary key, path text, file_size integer, mtime_ns integer, "
+		"compression text, part_size integer)",
+		"create index upload_state_path on upload_state (path)",
+		"create table upload_part (upload_id text, part_index integer, range_start integer, range_end integer, "
+		"checksum text, primary key (upload_id, part_index))",
+	),
+	(
+		# small files packed into tar bundles, each bundle is a single archive
+		"create table bundle (archive_id text primary key, location text, checksum text, archive_size integer, "
+		"member_count integer, timestamp text)",
+		"create table bundle_member (id integer primary key, path text, file_size integer, mtime float, "
+		"mtime_ns integer, archive_id text, offset integer, length integer, compression text, timestamp text)",
+		"create index bundle_member_lookup on bundle_member (path, file_size, mtime_ns)",
+		"create index bundle_member_archive_id on bundle_member (archive_id)",
+	),
+	(
+		# megabyte aligned range of the bundle covering the member, used for ranged retrievals
+		"alter table bundle_member add column retrieval_start integer",
+		"alter table bundle_member add column retrieval_end integer",
+		"update bundle_member set retrieval_start = offset / 1048576 * 1048576, "
+		"retrieval_end = min((select archive_size from bundle where bundle.archive_id = bundle_member.archive_id), "
+		"(offset + max(length, 1) + 1048575) / 1048576 * 1048576) - 1",
+	),
+	(
+		# retrieval jobs and downloaded ranges of their output, used to resume interrupted restores
+		"create table restore_job (job_id text primary key, archive_id text, range_start integer, range_end integer, "
+		"created integer)",
+		"create index restore_job_archive_id on restore_job (archive_id, range_start, range_end)",
+		"create table restore_chunk (job_id text, range_start integer, range_end integer, checksum text, "
+		"primary key (job_id, range_start))",
+	),
+	(
+		# frame index of archives compressed into independent zstd frames
+		"create table frame (archive_id text, frame_index integer, uncompressed_offset integer, "
+		"uncompressed_size integer, compressed_offset integer, compressed_size integer, "
+		"primary key (archive_id, frame_index))",
+	),
+	(
+		# compression probe results per file extension
+		"create table compression_stats (extension text primary key, samples integer, incompressible integer)",
+	),
+	(
+		# trained zstd dictionaries, each dictionary is also uploaded as an archive
+		"create table dictionary (id integer primary key, dict_id integer unique, archive_id text, location text, "
+		"checksum text, data blob, timestamp text)",
+		"alter table sync_history add column dict_id integer",
+		"alter table bundle_member add column dict_id integer",
+	),
+	(
+		# content hashes of the original file, used to find an archive with the same content under another path
+		"alter table sync_history add column content_hash text",
+		"alter table sync_history add column tree_hash text",
+		"create index sync_history_content_hash on sync_history (content_hash)",
+	),
+	(
+		# cheap fingerprint of the file content, files are fully hashed only if their fingerprint is found
+		"alter table sync_history add column fingerprint text",
+		"create index sync_history_fingerprint on sync_history (fingerprint)",
+	),
+	(
+		# snapshot of the source tree, directories with an unchanged modification time are not listed again
+		"create table scan_directory (path text primary key, mtime_ns integer)",
+		"create table scan_entry (directory text, name text, is_dir integer, file_size integer, mtime_ns integer, "
+		"primary key (directory, name))",
+	),
+	(
+		# compression settings of unfinished uploads, parts compressed with other settings cannot be resumed
+		"alter table upload_state add column compress_level integer",
+		"alter table upload_state add column frame_size integer",
+	),
+	(
+		# float modification time of the snapshot files as returned by os.stat, the lookup of rows without mtime_ns
+		# compares it exactly, entries stored before this version have null and their files are stat'ed again
+		"alter table scan_entry add column mtime float",
+	),
+]
+
+ROW_OVERHEAD = 120  # approximate memory cost of a cached row in bytes, excluding the path itself
+
+
+class RestoreItem:
+	"""
+	Latest backup of a file
+	offset, length and retrieval range are set only for files packed into a bundle.
+	"""
+
+	def __init__(
+		self, path, file_size, mtime, mtime_ns, archive_id, compression, dict_id=None, offset=None, length=None,
+		retrieval_start=None, retrieval_end=None):
+		self.path = path
+		self.file_size = file_size
+		self.mtime = mtime
+		self.mtime_ns = mtime_ns
+		self.archive_id = archive_id
+		self.compression = compression
+		self.dict_id = dict_id
+		self.offset = offset
+		self.length = length
+		self.retrieval_start = retrieval_start
+		self.retrieval_end = retrieval_end
+
+
+class Catalog:
+	"""
+	Sqlite catalog of the backed up files
+	The connection is shared by file workers, every access is serialized with a lock.
+	"""
+
+	def __init__(self, db_file, cache_size=1024):
+		"""
+		:param db_file: sqlite database file
+		:param cache_size: memory budget in MB for preloading the catalog
+		"""
+		self.db_file = db_file
+		self.cache_size = cache_size * 1024 * 1024
+		self.cache = None  # None if the catalog is not preloaded
+		self.lock = threading.Lock()
+		try:
+			self.conn = sqlite3.connect(self.db_file, isolation_level=None, check_same_thread=False)
+			self.conn.execute('pragma journal_mode=wal')
+			logging.info("connected to glacier rsync db")
+		except sqlite3.Error as e:
+			logging.error(f"Cannot create glacier rsync db: {str(e)}")
+			raise ValueError(f"Cannot create glacier rsync db: {str(e)}")
+
+		self._migrate()
+
+	def _migrate(self):
+		"""
+		Bring the db schema to the latest version
+		Each migration is applied in its own transaction together with the version update.
+		"""
+		cur = self.conn.cursor()
+		try:
+			cur.execute("create table if not exists schema_version (version integer not null)")
+			cur.execute("select max(version) from schema_version")
+			version = cur.fetchone()[0] or 0
+			for target_version, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+				logging.info(f"migrating glacier rsync db to schema version {target_version}")
+				cur.execute("begin")
+				for statement in statements:
+					cur.execute(statement)
+				cur.execute("insert into schema_version (version) values (?)", (target_version,))
+				cur.execute("commit")
+		except sqlite3.OperationalError as e:
+			if self.conn.in_transaction:
+				cur.execute("rollback")
+			logging.error(f"DB error. Cannot migrate the db schema: {str(e)})")
+			sys.exit(2)
+		finally:
+			cur.close()
+
+	def close(self):
+		"""
+		Close database connection
+		"""
+		with self.lock:
+			self.conn.commit()
+			self.conn.close()
+
+	def load_cache(self):
+		"""
+		Load all backed up (path, file_size, mtime) keys into memory
+		If the estimated size of the catalog is larger than the memory budget, lookups fall back to db queries.
+		"""
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute(
+					"select count(*), coalesce(sum(length(path)), 0) from "
+					"(select path from sync_history union all select path from bundle_member)")
+				row_count, path_bytes = cur.fetchone()
+				estimated_size = row_count * ROW_OVERHEAD + path_bytes
+				if estimated_size > self.cache_size:
+					logging.info(
+						f"catalog has {row_count} rows, estimated {estimated_size // (1024 * 1024)} MB is larger "
+						f"than the cache budget. Files will be checked with db queries")
+					return
+
+				cur.execute("select path, file_size, mtime, mtime_ns from sync_history")
+				self.cache = set(
+					self._cache_key(path, file_size, mtime_ns) if mtime_ns is not None
+					else self._legacy_cache_key(path, file_size, mtime)
+					for path, file_size, mtime, mtime_ns in cur
+				)
+				cur.execute("select path, file_size, mtime_ns from bundle_member")
+				self.cache.update(self._cache_key(*row) for row in cur)
+				logging.info(f"catalog is loaded into memory, {row_count} rows")
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot load the catalog: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+
+	def is_backed_up(self, path, file_size, mtime_ns, mtime):
+		"""
+		Check if a file with the given stats is in the catalog
+		:param path: absolute path of the file
+		:param file_size: size of the file
+		:param mtime_ns: modification time of the file in nanoseconds
+		:param mtime: modification time of the file in seconds, used for rows without mtime_ns
+		:return: True if file is backed up
+		"""
+		if self.cache is not None:
+			if self._cache_key(path, file_size, mtime_ns) in self.cache:
+				return True
+			if self._legacy_cache_key(path, file_size, mtime) not in self.cache:
+				return False
+
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute(
+					"select 1 from sync_history where path=? and file_size=? and mtime_ns=? limit 1",
+					(path, file_size, mtime_ns))
+				if cur.fetchone() is not None:
+					return True
+				cur.execute(
+					"select 1 from bundle_member where path=? and file_size=? and mtime_ns=? limit 1",
+					(path, file_size, mtime_ns))
+				if cur.fetchone() is not None:
+					return True
+				# rows of older schema versions only have the float mtime, upgrade them on the first match
+				cur.execute(
+					"update sync_history set mtime_ns=? where path=? and file_size=? and mtime_ns is null and mtime=?",
+					(mtime_ns, path, file_size, mtime))
+				is_backed_up = cur.rowcount > 0
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot check if the file is backed up: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+			if is_backed_up and self.cache is not None:
+				self.cache.add(self._cache_key(path, file_size, mtime_ns))
+		return is_backed_up
+
+	def mark_backed_up(
+		self, path, file_size, mtime_ns, mtime, archive_id, location, checksum, compression, timestamp, frames=None,
+		dict_id=None, content_hash=None, tree_hash=None, fingerprint=None):
+		"""
+		Insert a backed up file into the catalog
+		:param frames: list of Frame if the archive is made of independent frames
+		:param dict_id: id of the dictionary the file is compressed with
+		:param content_hash: fast hash of the file content, None if deduplication is disabled
+		:param tree_hash: tree hash of the file content, None if deduplication is disabled
+		:param fingerprint: fingerprint of the file content, None if deduplication is disabled
+		"""
+		self._execute_write(
+			"Cannot mark the file as backed up",
+			(
+				"insert into sync_history "
+				"(path, file_size, mtime, mtime_ns, archive_id, location, checksum, compression, timestamp, dict_id, "
+				"content_hash, tree_hash, fingerprint) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				(
+					path, file_size, mtime, mtime_ns, archive_id, location, checksum, compression, timestamp, dict_id,
+					content_hash, tree_hash, fingerprint
+				)
+			),
+			*((
+				"insert into frame (archive_id, frame_index, uncompressed_offset, uncompressed_size, "
+				"compressed_offset, compressed_size) values (?, ?, ?, ?, ?, ?)",
+				(
+					archive_id, frame.frame_index, frame.uncompressed_offset, frame.uncompressed_size,
+					frame.compressed_offset, frame.compressed_size
+				)
+			) for frame in frames or []),
+		)
+		if self.cache is not None:
+			with self.lock:
+				self.cache.add(self._cache_key(path, file_size, mtime_ns))
+
+	def mark_bundle_backed_up(self, archive_id, location, checksum, archive_size, members, timestamp):
+		"""
+		Insert a bundle and all of its members into the catalog
+		:param members: list of BundleMember
+		"""
+		self._execute_write(
+			"Cannot mark the bundle as backed up",
+			(
+				"insert into bundle (archive_id, location, checksum, archive_size, member_count, timestamp) "
+				"values (?, ?, ?, ?, ?, ?)",
+				(archive_id, location, checksum, archive_size, len(members), timestamp)
+			),
+			*((
+				"insert into bundle_member "
+				"(path, file_size, mtime, mtime_ns, archive_id, offset, length, compression, timestamp, "
+				"retrieval_start, retrieval_end, dict_id) "
+				"values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				(
+					member.path, member.file_size, member.mtime, member.mtime_ns, archive_id, member.offset,
+					member.length, member.compression, timestamp, member.retrieval_start, member.retrieval_end,
+					member.dict_id
+				)
+			) for member in members),
+		)
+		if self.cache is not None:
+			with self.lock:
+				self.cache.update(
+					self._cache_key(member.path, member.file_size, member.mtime_ns) for member in members)
+
+	def add_dictionary(self, dict_id, archive_id, location, checksum, data, timestamp):
+		"""
+		Insert an uploaded compression dictionary
+		"""
+		self._execute_write(
+			"Cannot store the compression dictionary",
+			(
+				"insert or replace into dictionary (dict_id, archive_id, location, checksum, data, timestamp) "
+				"values (?, ?, ?, ?, ?, ?)",
+				(dict_id, archive_id, location, checksum, data, timestamp)
+			),
+		)
+
+	def get_dictionary(self, dict_id=None):
+		"""
+		:param dict_id: dictionary id, None for the last uploaded dictionary
+		:return: tuple(dict id, dictionary bytes), None if there is no such dictionary
+		"""
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				if dict_id is None:
+					cur.execute("select dict_id, data from dictionary order by id desc limit 1")
+				else:
+					cur.execute("select dict_id, data from dictionary where dict_id=?", (dict_id,))
+				return cur.fetchone()
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot read the compression dictionary: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+
+	def get_scan_directory(self, path):
+		"""
+		:param path: absolute path of a directory
+		:return: tuple(modification time in nanoseconds, list of tuple(name, is directory, file size, file modification
+			time in nanoseconds, file modification time in seconds)) of the last listing, None if the directory is not
+			in the snapshot
+		"""
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute("select mtime_ns from scan_directory where path=?", (path,))
+				row = cur.fetchone()
+				if row is None:
+					return None
+				cur.execute("select name, is_dir, file_size, mtime_ns, mtime from scan_entry where directory=?", (path,))
+				return row[0], [(name, bool(is_dir), *stats) for name, is_dir, *stats in cur]
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot read the scan snapshot: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+
+	def set_scan_directory(self, path, mtime_ns, entries, removed_dirs):
+		"""
+		Replace the snapshot of a directory
+		:param path: absolute path of the directory
+		:param mtime_ns: modification time of the directory, None if it must be listed again next time
+		:param entries: list of tuple(name, is directory, file size, file modification time in nanoseconds, file
+			modification time in seconds)
+		:param removed_dirs: sub directories that do not exist anymore, their snapshots are deleted recursively
+		"""
+		removed = []
+		for removed_dir in removed_dirs:
+			prefix = removed_dir + os.sep
+			removed.append(("delete from scan_directory where path=? or substr(path, 1, ?)=?", (
+				removed_dir, len(prefix), prefix)))
+			removed.append(("delete from scan_entry where directory=? or substr(directory, 1, ?)=?", (
+				removed_dir, len(prefix), prefix)))
+		self._execute_write(
+			"Cannot store the scan snapshot",
+			*removed,
+			("insert or replace into scan_directory (path, mtime_ns) values (?, ?)", (path, mtime_ns)),
+			("delete from scan_entry where directory=?", (path,)),
+			*((
+				"insert into scan_entry (directory, name, is_dir, file_size, mtime_ns, mtime) values (?, ?, ?, ?, ?, ?)",
+				(path, *entry)
+			) for entry in entries),
+		)
+
+	def get_extension_stats(self):
+		"""
+		:return: dict(extension -> [number of probed files, number of incompressible files])
+		"""
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute("select extension, samples, incompressible from compression_stats")
+				return {extension: [samples, incompressible] for extension, samples, incompressible in cur}
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot read the compression stats: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+
+	def set_extension_stats(self, extension, samples, incompressible):
+		"""
+		Store the compression probe results of a file extension
+		"""
+		self._execute_write(
+			"Cannot store the compression stats",
+			(
+				"insert or replace into compression_stats (extension, samples, incompressible) values (?, ?, ?)",
+				(extension, samples, incompressible)
+			),
+		)
+
+	def has_fingerprint(self, fingerprint):
+		"""
+		:param fingerprint: fingerprint of a file
+		:return: True if a backed up file has the same fingerprint
+		"""
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute("select 1 from sync_history where fingerprint=? limit 1", (fingerprint,))
+				return cur.fetchone() is not None
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot look up the fingerprint: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+
+	def find_archive(self, file_size, content_hash, tree_hash):
+		"""
+		Find an archive of a file with the same content
+		:param file_size: size of the file
+		:param content_hash: fast hash of the file content
+		:param tree_hash: tree hash of the file content
+		:return: tuple(archive id, location, checksum, compression, timestamp, dict id), None if there is no such archive
+		"""
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute(
+					"select archive_id, location, checksum, compression, timestamp, dict_id from sync_history "
+					"where content_hash=? and file_size=? and tree_hash=? limit 1",
+					(content_hash, file_size, tree_hash))
+				return cur.fetchone()
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot look up the content hash: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+
+	def get_restore_items(self, prefix):
+		"""
+		Find the latest backup of every file under the given path
+		:param prefix: path of a file or directory, empty string for all files
+		:return: list of RestoreItem
+		"""
+		prefix = os.path.abspath(prefix).rstrip(os.sep) if prefix else ""  # the root directory matches all files
+		directory = prefix + os.sep
+		params = (prefix, prefix, len(directory), directory)
+		items = {}
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute(
+					"select path, file_size, mtime, mtime_ns, archive_id, compression, dict_id from sync_history "
+					"where (?='' or path=? or substr(path, 1, ?)=?) and archive_id is not null order by id",
+					params)
+				for row in cur:
+					items[row[0]] = RestoreItem(*row)
+				cur.execute(
+					"select path, file_size, mtime, mtime_ns, archive_id, compression, dict_id, offset, length, "
+					"retrieval_start, retrieval_end from bundle_member "
+					"where (?='' or path=? or substr(path, 1, ?)=?) order by id",
+					params)
+				for row in cur:
+					item = RestoreItem(*row)
+					if row[0] not in items or item.mtime >= items[row[0]].mtime:  # keep the newest version
+						items[row[0]] = item
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot read the backed up files: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+		return list(items.values())
+
+	def get_frames(self, archive_id):
+		"""
+		:return: list of Frame of the archive in order, empty if the archive is not made of independent frames
+		"""
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute(
+					"select frame_index, uncompressed_offset, uncompressed_size, compressed_offset, compressed_size "
+					"from frame where archive_id=? order by frame_index",
+					(archive_id,))
+				return [Frame(*row) for row in cur]
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot read the frame index: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+
+	def get_restore_job(self, archive_id, range_start, range_end):
+		"""
+		:return: tuple(job id, created epoch) of the last retrieval job of the given range, None if there is no job
+		"""
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute(
+					"select job_id, created from restore_job where archive_id=? and range_start is ? and range_end is ? "
+					"order by created desc limit 1",
+					(archive_id, range_start, range_end))
+				return cur.fetchone()
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot read restore state: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+
+	def add_restore_job(self, job_id, archive_id, range_start, range_end, created):
+		"""
+		Persist a new retrieval job
+		"""
+		self._execute_write(
+			"Cannot save restore state",
+			(
+				"insert into restore_job (job_id, archive_id, range_start, range_end, created) values (?, ?, ?, ?, ?)",
+				(job_id, archive_id, range_start, range_end, created)
+			),
+		)
+
+	def get_restore_chunks(self, job_id):
+		"""
+		:return: dict(range start -> (range end, checksum)) of the downloaded ranges of a job output
+		"""
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute("select range_start, range_end, checksum from restore_chunk where job_id=?", (job_id,))
+				return {row[0]: row[1:] for row in cur}
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot read restore state: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+
+	def add_restore_chunk(self, job_id, range_start, range_end, checksum):
+		"""
+		Persist a downloaded range of a job output
+		"""
+		self._execute_write(
+			"Cannot save restore state",
+			(
+				"insert or replace into restore_chunk (job_id, range_start, range_end, checksum) values (?, ?, ?, ?)",
+				(job_id, range_start, range_end, checksum)
+			),
+		)
+
+	def clear_restore_chunks(self, job_id):
+		"""
+		Forget the downloaded ranges of a job output, e.g. if the output is corrupt
+		"""
+		self._execute_write(
+			"Cannot save restore state",
+			("delete from restore_chunk where job_id=?", (job_id,)),
+		)
+
+	def finish_restore_job(self, job_id):
+		"""
+		Forget a finished, failed or expired retrieval job
+		"""
+		self._execute_write(
+			"Cannot save restore state",
+			("delete from restore_chunk where job_id=?", (job_id,)),
+			("delete from restore_job where job_id=?", (job_id,)),
+		)
+
+	def get_upload(self, path):
+		"""
+		Find the unfinished upload of a file
+		:param path: absolute path of the file
+		:return: tuple(upload_id, file_size, mtime_ns, compression, compress_level, frame_size, part_size), None if
+			there is no unfinished upload
+		"""
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute(
+					"select upload_id, file_size, mtime_ns, compression, compress_level, frame_size, part_size "
+					"from upload_state where path=?",
+					(path,))
+				return cur.fetchone()
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot read upload state: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+
+	def get_upload_parts(self, upload_id):
+		"""
+		:param upload_id: multipart upload id
+		:return: dict(part index -> (range start, range end, checksum)) of the completed parts
+		"""
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute(
+					"select part_index, range_start, range_end, checksum from upload_part where upload_id=?",
+					(upload_id,))
+				return {row[0]: row[1:] for row in cur}
+			except sqlite3.OperationalError as e:
+				logging.error(f"DB error. Cannot read upload state: {str(e)})")
+				sys.exit(3)
+			finally:
+				cur.close()
+
+	def start_upload(self, path, file_size, mtime_ns, compression, compress_level, frame_size, upload_id, part_size):
+		"""
+		Persist a new multipart upload, an older unfinished upload of the same file is forgotten
+		"""
+		self._execute_write(
+			"Cannot save upload state",
+			("delete from upload_part where upload_id in (select upload_id from upload_state where path=?)", (path,)),
+			("delete from upload_state where path=?", (path,)),
+			(
+				"insert into upload_state (upload_id, path, file_size, mtime_ns, compression, compress_level, "
+				"frame_size, part_size) values (?, ?, ?, ?, ?, ?, ?, ?)",
+				(upload_id, path, file_size, mtime_ns, compression, compress_level, frame_size, part_size)
+			),
+		)
+
+	def add_upload_part(self, upload_id, part_index, range_start, range_end, checksum):
+		"""
+		Persist a completed part of a multipart upload
+		"""
+		self._execute_write(
+			"Cannot save upload state",
+			(
+				"insert or replace into upload_part (upload_id, part_index, range_start, range_end, checksum) "
+				"values (?, ?, ?, ?, ?)",
+				(upload_id, part_index, range_start, range_end, checksum)
+			),
+		)
+
+	def finish_upload(self, upload_id):
+		"""
+		Forget a completed or aborted multipart upload
+		"""
+		self._execute_write(
+			"Cannot save upload state",
+			("delete from upload_part where upload_id=?", (upload_id,)),
+			("delete from upload_state where upload_id=?", (upload_id,)),
+		)
+
+	def _execute_write(self, error_message, *statements):
+		"""
+		Execute write statements in a single transaction
+		:param error_message: message to log if the statements fail
+		:param statements: tuple(sql, parameters)
+		"""
+		with self.lock:
+			cur = self.conn.cursor()
+			try:
+				cur.execute("begin")
+				for sql, parameters in statements:
+					cur.execute(sql, parameters)
+				cur.execute("commit")
+			except sqlite3.OperationalError as e:
+				if self.conn.in_transaction:
+					cur.execute("rollback")
+				logging.error(f"DB error. {error_message}: {str(e)})")
+				sys.exit(1)
+			finally:
+				cur.close()
+
+	@staticmethod
+	def _cache_key(path, file_size, mtime_ns):
+		"""
+		Compact cache key of a catalog row, a single string is much smaller than a tuple of objects
+		"""
+		return f"{file_size}|{mtime_ns}|{path}"
+
+	@staticmethod
+	def _legacy_cache_key(path, file_size, mtime):
+		"""
+		Cache key of a catalog row without mtime_ns
+		"""
+		return f"{file_size}|f{mtime!r}|{path}"
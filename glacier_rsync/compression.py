@@ -0,0 +1,276 @@
+import logging
+import threading
+
+PLAIN = "plain"  # compression column of uncompressed files
+BLOCK_SIZE = 1024 * 1024  # input read at once by streaming compressors, output written at once by decompressors
+
+
+class Codec:
+	"""
+	A compression algorithm
+	Every codec can compress a stream, compress and decompress independent frames, and decompress a stream of
+	concatenated frames. Modules of the codec are imported on first use, so only the selected codec has to be installed.
+	"""
+	name = None
+	extension = None  # suffix of compressed bundle members
+	package = None  # pip package providing the codec
+	min_level = None
+	max_level = None
+	default_level = None  # level used without --compress-level
+	supports_threads = False  # threads arguments are ignored by codecs without thread support
+	supports_dictionary = False  # dictionary arguments are ignored by codecs without dictionary support
+
+	def check_available(self):
+		"""
+		:raise ValueError: if the package of the codec is not installed
+		"""
+		try:
+			self._import()
+		except ImportError:
+			msg = f"cannot import {self.name}. Please install `{self.package}' package!"
+			logging.error(msg)
+			raise ValueError(msg)
+
+	def check_level(self, level):
+		"""
+		:raise ValueError: if the level is not supported by the codec
+		"""
+		if not self.min_level <= level <= self.max_level:
+			msg = f"{self.name} compression level must be between {self.min_level} and {self.max_level}"
+			logging.error(msg)
+			raise ValueError(msg)
+
+	def reader(self, f, level, threads=0, dictionary=None):
+		"""
+		:param f: file object of the original data
+		:param level: compression level
+		:param threads: number of compression threads, ignored if the codec does not support threads
+		:param dictionary: compression dictionary
+		:return: object with readinto returning the compressed stream
+		"""
+		raise NotImplementedError
+
+	def writer(self, dst, dictionary=None):
+		"""
+		:param dst: file object of the decompressed data
+		:param dictionary: dictionary the stream is compressed with
+		:return: object with write and close, decompressing the written stream into dst
+		"""
+		return _DecompressingWriter(dst, self._decompressor)
+
+	def compress(self, data, level, dictionary=None):
+		"""
+		Compress data into an independent frame
+		"""
+		raise NotImplementedError
+
+	def decompress(self, data, size, dictionary=None):
+		"""
+		Decompress a single frame
+		:param data: compressed frame
+		:param size: size of the decompressed data
+		:param dictionary: dictionary the frame is compressed with
+		"""
+		raise NotImplementedError
+
+	def _import(self):
+		raise NotImplementedError
+
+	def _decompressor(self):
+		"""
+		:return: new decompressor with the decompress(data, max_length), eof, needs_input and unused_data interface of
+			lzma.LZMADecompressor
+		"""
+		raise NotImplementedError
+
+
+class ZstdCodec(Codec):
+	"""
+	zstd, fast with a good ratio. The long variant enables long distance matching with a 128 MB window, which finds
+	repetitions far apart in large files like logs.
+	"""
+	extension = ".zst"
+	package = "zstandard"
+	min_level = -7
+	max_level = 22
+	default_level = 3
+	supports_threads = True
+	supports_dictionary = True
+
+	def __init__(self, name="zstd", long_distance=False):
+		self.name = name
+		self.long_distance = long_distance
+		self.local = threading.local()  # compressors are not thread safe, one compressor per thread and level
+
+	def reader(self, f, level, threads=0, dictionary=None):
+		return self._new_compressor(level, threads, dictionary=dictionary).stream_reader(f)
+
+	def writer(self, dst, dictionary=None):
+		return self._decompressor(dictionary).stream_writer(dst, closefd=False)
+
+	def compress(self, data, level, dictionary=None):
+		return self._compressor(level, dictionary=dictionary).compress(data)
+
+	def decompress(self, data, size, dictionary=None):
+		return self._decompressor(dictionary).decompress(data, max_output_size=size)
+
+	@staticmethod
+	def _decompressor(dictionary=None):
+		import zstandard as zstd
+		return zstd.ZstdDecompressor(dict_data=dictionary)
+
+	def _import(self):
+		import zstandard  # noqa: F401
+
+	def _compressor(self, level, dictionary=None):
+		"""
+		:return: compressor of the current thread for the given level and dictionary
+		"""
+		compressors = getattr(self.local, "compressors", None)
+		if compressors is None:
+			compressors = self.local.compressors = {}
+		key = (level, id(dictionary))
+		if key not in compressors:
+			compressors[key] = self._new_compressor(level, dictionary=dictionary)
+		return compressors[key]
+
+	def _new_compressor(self, level, threads=0, dictionary=None):
+		import zstandard as zstd
+		if not self.long_distance:
+			return zstd.ZstdCompressor(level=level, threads=threads, dict_data=dictionary)
+		# a 128 MB window is the largest window decompressors accept without extra settings
+		params = zstd.ZstdCompressionParameters.from_level(level, enable_ldm=True, window_log=27, threads=threads)
+		return zstd.ZstdCompressor(compression_params=params, dict_data=dictionary)
+
+
+class Lz4Codec(Codec):
+	"""
+	lz4, compresses and decompresses at GB/s with a lower ratio
+	"""
+	name = "lz4"
+	extension = ".lz4"
+	package = "lz4"
+	min_level = 0
+	max_level = 16
+	default_level = 0
+
+	def reader(self, f, level, threads=0, dictionary=None):
+		import lz4.frame
+		compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+		return _CompressingReader(f, compressor.compress, compressor.flush, header=compressor.begin())
+
+	def compress(self, data, level, dictionary=None):
+		import lz4.frame
+		return lz4.frame.compress(data, compression_level=level)
+
+	def decompress(self, data, size, dictionary=None):
+		import lz4.frame
+		return lz4.frame.decompress(data)
+
+	def _import(self):
+		import lz4.frame  # noqa: F401
+
+	def _decompressor(self):
+		import lz4.frame
+		return lz4.frame.LZ4FrameDecompressor()
+
+
+class XzCodec(Codec):
+	"""
+	xz, slow with the best ratio, for archives that are rarely restored
+	"""
+	name = "xz"
+	extension = ".xz"
+	package = "lzma (python standard library)"
+	min_level = 0
+	max_level = 9
+	default_level = 6
+
+	def reader(self, f, level, threads=0, dictionary=None):
+		import lzma
+		compressor = lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=level)
+		return _CompressingReader(f, compressor.compress, compressor.flush)
+
+	def compress(self, data, level, dictionary=None):
+		import lzma
+		return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+	def decompress(self, data, size, dictionary=None):
+		import lzma
+		return lzma.decompress(data, format=lzma.FORMAT_XZ)
+
+	def _import(self):
+		import lzma  # noqa: F401
+
+	def _decompressor(self):
+		import lzma
+		return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+
+
+CODECS = {
+	codec.name: codec for codec in (ZstdCodec(), ZstdCodec("zstd-long", long_distance=True), Lz4Codec(), XzCodec())
+}
+
+
+def get_codec(name):
+	"""
+	:param name: compression column of a file
+	:return: Codec object, None for uncompressed files
+	"""
+	if name is None or name == PLAIN:
+		return None
+	return CODECS[name]
+
+
+class _CompressingReader:
+	"""
+	readinto interface over a compressor object with compress and flush methods
+	"""
+
+	def __init__(self, f, compress, flush, header=b""):
+		self.f = f
+		self.compress = compress
+		self.flush = flush
+		self.pending = memoryview(header)
+		self.finished = False
+
+	def readinto(self, buffer):
+		while not self.pending and not self.finished:
+			data = self.f.read(BLOCK_SIZE)
+			if data:
+				self.pending = memoryview(self.compress(data))
+			else:
+				self.pending = memoryview(self.flush())
+				self.finished = True
+		size = min(len(buffer), len(self.pending))
+		buffer[:size] = self.pending[:size]
+		self.pending = self.pending[size:]
+		return size
+
+
+class _DecompressingWriter:
+	"""
+	Stream writer over decompressor objects, concatenated frames are decompressed one after the other
+	Output is produced in BLOCK_SIZE pieces, so a highly compressed input does not have to fit into memory decompressed.
+	"""
+
+	def __init__(self, dst, new_decompressor):
+		self.dst = dst
+		self.new_decompressor = new_decompressor
+		self.decompressor = new_decompressor()
+
+	def write(self, data):
+		while True:
+			self.dst.write(self.decompressor.decompress(data, max_length=BLOCK_SIZE))
+			if self.decompressor.eof:  # the next frame starts in the unused data
+				data = self.decompressor.unused_data
+				self.decompressor = self.new_decompressor()
+				if not data:
+					return
+			elif self.decompressor.needs_input:
+				return
+			else:
+				data = b""
+
+	def close(self):
+		pass
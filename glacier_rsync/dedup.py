@@ -0,0 +1,117 @@
+import io
+import logging
+
+from glacier_rsync.tree_hash import TreeHasher
+
+READ_SIZE = 1024 * 1024
+FINGERPRINT_BLOCK_SIZE = 64 * 1024  # bytes hashed at the beginning, in the middle and at the end of a file
+
+
+def check_available():
+	"""
+	:raise ValueError: if xxhash is not installed
+	"""
+	try:
+		import xxhash  # noqa: F401
+	except ImportError:
+		msg = "cannot import xxhash. Please install `xxhash' package!"
+		logging.error(msg)
+		raise ValueError(msg)
+
+
+class ContentHasher:
+	"""
+	Fast hash and tree hash of the content of a file, calculated in a single pass
+	The fast xxh3 hash is indexed in the catalog to find candidates, the sha256 tree hash confirms a match.
+	"""
+
+	def __init__(self):
+		import xxhash
+		self.fast = xxhash.xxh3_128()
+		self.tree = TreeHasher()
+
+	def update(self, data):
+		"""
+		:param data: next bytes-like object of the file
+		"""
+		self.fast.update(data)
+		self.tree.update(data)
+
+	def hexdigests(self):
+		"""
+		:return: tuple(fast hash hex digest, tree hash hex digest)
+		"""
+		return self.fast.hexdigest(), self.tree.hexdigest()
+
+
+class HashingReader:
+	"""
+	File object wrapper hashing the content while it is read for the upload, so the file is read once
+	"""
+
+	def __init__(self, f):
+		"""
+		:param f: file object opened at the beginning of the file
+		"""
+		self.f = f
+		self.hasher = ContentHasher()
+		self.skipped = False  # a skipped range is not hashed
+
+	def read(self, size=-1):
+		data = self.f.read(size)
+		self.hasher.update(data)
+		return data
+
+	def readinto(self, buffer):
+		size = self.f.readinto(buffer)
+		if size:
+			self.hasher.update(memoryview(buffer)[:size])
+		return size
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		self.skipped = True
+		return self.f.seek(offset, whence)
+
+	def close(self):
+		self.f.close()
+
+	def hexdigests(self):
+		"""
+		:return: tuple(fast hash hex digest, tree hash hex digest) of the file, None if a range is skipped
+		"""
+		return None if self.skipped else self.hasher.hexdigests()
+
+
+def fingerprint(path, file_size):
+	"""
+	Cheap fingerprint of a file to find deduplication candidates without reading the whole file
+	:param path: absolute path of the file
+	:param file_size: size of the file
+	:return: xxh3 hex digest of the size and FINGERPRINT_BLOCK_SIZE bytes at the beginning, middle and end
+	"""
+	import xxhash
+	hasher = xxhash.xxh3_128(file_size.to_bytes(8, "little"))
+	with open(path, 'rb') as f:
+		if file_size <= 3 * FINGERPRINT_BLOCK_SIZE:
+			hasher.update(f.read())
+		else:
+			for offset in (0, (file_size - FINGERPRINT_BLOCK_SIZE) // 2, file_size - FINGERPRINT_BLOCK_SIZE):
+				f.seek(offset)
+				hasher.update(f.read(FINGERPRINT_BLOCK_SIZE))
+	return hasher.hexdigest()
+
+
+def hash_file(path):
+	"""
+	:param path: absolute path of the file
+	:return: tuple(fast hash hex digest, tree hash hex digest) of the file content
+	"""
+	hasher = ContentHasher()
+	buffer = bytearray(READ_SIZE)
+	with open(path, 'rb', buffering=0) as f:
+		while True:
+			size = f.readinto(buffer)
+			if not size:
+				break
+			hasher.update(memoryview(buffer)[:size])
+	return hasher.hexdigests()
@@ -0,0 +1,50 @@
+import logging
+import os
+
+from glacier_rsync.scanner import ScanEntry, Scanner
+
+MAX_SAMPLE_FILES = 10000
+SAMPLE_SIZE_FACTOR = 100  # zstd recommends about 100 times the dictionary size of samples
+
+
+def train_dictionary(src, dictionary_size, max_file_size):
+	"""
+	Train a zstd dictionary from the small files of a folder
+	Files are sampled in scan order until MAX_SAMPLE_FILES files or SAMPLE_SIZE_FACTOR times the dictionary size are read.
+	:param src: file or folder to back up
+	:param dictionary_size: size of the dictionary in bytes
+	:param max_file_size: only files up to this size are sampled, larger files are not compressed with the dictionary
+	:return: zstd.ZstdCompressionDict, None if there are not enough samples
+	"""
+	import zstandard as zstd
+
+	samples = []
+	sample_size = 0
+	entries = Scanner.walk(os.path.abspath(src)) if os.path.isdir(src) else [ScanEntry.from_stat(src, os.stat(src))]
+	for entry in entries:
+		if not 0 < entry.size <= max_file_size:
+			continue
+		try:
+			with open(entry.path, 'rb') as f:
+				samples.append(f.read(max_file_size))
+		except OSError:
+			continue
+		sample_size += len(samples[-1])
+		if len(samples) >= MAX_SAMPLE_FILES or sample_size >= dictionary_size * SAMPLE_SIZE_FACTOR:
+			break
+
+	logging.info(f"training a compression dictionary from {len(samples)} files, {sample_size} bytes")
+	try:
+		return zstd.train_dictionary(dictionary_size, samples)
+	except zstd.ZstdError as e:
+		logging.warning(f"cannot train a compression dictionary, files are compressed without it: {str(e)}")
+		return None
+
+
+def load_dictionary(data):
+	"""
+	:param data: dictionary bytes stored in the catalog
+	:return: zstd.ZstdCompressionDict
+	"""
+	import zstandard as zstd
+	return zstd.ZstdCompressionDict(data)
@@ -1,38 +1,190 @@
+import io
+import queue
+import threading
+import time
+
+
 class FileCache:
-	def __init__(self, f, compression=False):
+	"""
+	Read a file in parts, optionally compressing it on the fly
+	Parts are filled in place with readinto, so every byte is copied once from the file or the compressor output to
+	the part buffer.
+	"""
+
+	def __init__(
+		self, f, compression=None, level=3, threads=0, frame_size=0, executor=None, window=1, dictionary=None):
+		"""
+		:param f: file object
+		:param compression: Codec object to compress the file with, None for no compression
+		:param level: compression level
+		:param threads: number of compression threads, 0 compresses in the calling thread
+		:param frame_size: compress every frame_size bytes into an independent frame, 0 for a single frame
+		:param executor: executor compressing the frames, required if frame_size is set
+		:param window: maximum number of frames compressed at the same time
+		:param dictionary: compression dictionary, only used for a single frame
+		"""
 		self.compression = compression
 		self.f = f
-		if compression:
-			import zstandard as zstd
-			self.cctx = zstd.ZstdCompressor()
-			self.reader = self.cctx.read_to_iter(self.f, write_size=8192)
+		self.seekable = None
+		if compression and frame_size > 0:
+			from glacier_rsync.seekable import SeekableCompressor
+			self.seekable = SeekableCompressor(self.f, frame_size, executor, window, compression.name, level)
+			self.reader = self.seekable
+		elif compression:
+			self.reader = compression.reader(self.f, level, threads=threads, dictionary=dictionary)
 		else:
 			self.reader = self.f
-		self.next_chunk = b""
+		self.eof = False
+		self.pending = memoryview(b"")  # bytes read ahead by read_whole, returned by the next reads
+		self.bytes_read = 0  # bytes returned so far, compressed size if the stream is compressed
+		self.read_seconds = 0.0  # time spent reading and compressing
+
+	@property
+	def frames(self):
+		"""
+		:return: list of Frame read so far, None if the stream is not made of independent frames
+		"""
+		return self.seekable.frames if self.seekable is not None else None
+
+	def readinto(self, buffer):
+		"""
+		Fill the given buffer, only the last part of the stream can be shorter than the buffer
+		:param buffer: writable bytes-like object
+		:return: number of bytes read, 0 at the end of the stream
+		"""
+		view = memoryview(buffer)
+		filled = min(len(view), len(self.pending))
+		view[:filled] = self.pending[:filled]
+		self.pending = self.pending[filled:]
+		start = time.perf_counter()
+		while filled < len(view) and not self.eof:
+			size = self.reader.readinto(view[filled:])
+			if not size:
+				self.eof = True
+			else:
+				filled += size
+				self.bytes_read += size
+		self.read_seconds += time.perf_counter() - start
+		return filled
 
-	def grow_chunk(self):
-		new_chunk = self.reader.__next__()
-		if new_chunk is None:
-			raise StopIteration()
-		self.next_chunk = self.next_chunk + new_chunk
+	def read_whole(self, limit, buffer=None):
+		"""
+		Read the whole stream if it is not longer than limit
+		Otherwise the bytes read are kept for the next reads, so the stream can still be read in parts.
+		:param limit: maximum size of the stream in bytes
+		:param buffer: optional preallocated buffer of at least limit + 1 bytes, it must not be reused before the
+			returned part is uploaded and the next reads are done
+		:return: Part object of the whole stream, None if the stream is longer than limit
+		"""
+		if buffer is None:
+			buffer = bytearray(limit + 1)
+		size = self.readinto(memoryview(buffer)[:limit + 1])
+		if size <= limit:
+			return Part(buffer, size)
+		self.pending = memoryview(buffer)[:size]
+		return None
 
-	def read(self, n):
+	def skip(self, n):
+		"""
+		Skip n bytes of an uncompressed stream without reading them
+		:param n: number of bytes to skip
+		"""
 		if self.compression:
-			if self.next_chunk is None:
-				return None
+			raise ValueError("compressed stream cannot be skipped")
+		if self.pending:
+			raise ValueError("stream is already read ahead")
+		self.f.seek(n, io.SEEK_CUR)
+
+	def read(self, n, buffer=None):
+		"""
+		Read the next part
+		:param n: part size
+		:param buffer: optional preallocated buffer of at least n bytes
+		:return: Part object, None at the end of the stream
+		"""
+		if buffer is None:
+			buffer = bytearray(n)
+		size = self.readinto(memoryview(buffer)[:n])
+		if size == 0:
+			return None
+		return Part(buffer, size)
+
+
+class Part(io.RawIOBase):
+	"""
+	Read only, seekable file object over a part buffer
+	It can be given to botocore as request body without copying the buffer into a bytes object.
+	"""
+
+	def __init__(self, buffer, size):
+		super().__init__()
+		self.buffer = buffer
+		self.view = memoryview(buffer)[:size]
+		self.pos = 0
+		self.sha256 = None  # hex digest of the part, set if it is calculated before the upload
+
+	def __len__(self):
+		return len(self.view)
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def readinto(self, b):
+		size = min(len(b), len(self.view) - self.pos)
+		b[:size] = self.view[self.pos:self.pos + size]
+		self.pos += size
+		return size
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		if whence == io.SEEK_SET:
+			self.pos = offset
+		elif whence == io.SEEK_CUR:
+			self.pos += offset
+		elif whence == io.SEEK_END:
+			self.pos = len(self.view) + offset
 		else:
-			if not self.reader.readable():
-				return None
-		try:
-			if not self.compression:
-				rv = self.reader.read(n)
-			else:
-				while len(self.next_chunk) < n:
-					self.grow_chunk()
-				rv = self.next_chunk[:n]
-				self.next_chunk = self.next_chunk[n:]
-			return rv
-		except StopIteration:
-			rv = self.next_chunk
-			self.next_chunk = None
-			return rv
+			raise ValueError(f"invalid whence: {whence}")
+		self.pos = max(0, min(self.pos, len(self.view)))
+		return self.pos
+
+	def tell(self):
+		return self.pos
+
+	def getbuffer(self):
+		"""
+		:return: memoryview of the part data
+		"""
+		return self.view
+
+
+class BufferPool:
+	"""
+	Bounded set of part buffers
+	Buffers are allocated on first use and reused between parts, a buffer is handed out again only after it is released.
+	"""
+
+	def __init__(self, count, size):
+		self.count = count
+		self.size = size
+		self.allocated = 0
+		self.lock = threading.Lock()
+		self.free = queue.Queue()
+
+	def acquire(self):
+		"""
+		:return: a free buffer, blocks until one is released if all buffers are in use
+		"""
+		with self.lock:
+			if self.free.empty() and self.allocated < self.count:
+				self.allocated += 1
+				return bytearray(self.size)
+		return self.free.get()
+
+	def release(self, buffer):
+		"""
+		:param buffer: buffer acquired from this pool
+		"""
+		self.free.put(buffer)
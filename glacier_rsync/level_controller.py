@@ -0,0 +1,83 @@
+import logging
+import threading
+
+MIN_LEVEL = 1
+MAX_LEVEL = 19
+START_LEVEL = 3
+MIN_SAMPLE_SIZE = 1024 * 1024  # smaller files are too quick to measure
+SMOOTHING = 0.3  # weight of the newest measurement in the moving averages
+HYSTERESIS = 0.1  # rates within 10% of each other are considered balanced
+
+
+class LevelController:
+	"""
+	Pick the compression level of the next file from the measured compression and upload rates
+	Levels are clamped to min_level and max_level, which BackupUtil sets to the range of the codec within 1 to 19.
+	A file goes through a single compressor feeding its part uploads. The logical bytes per second of the file are
+	limited by the slower of the compressor and the uploads, and the uploads carry ratio logical bytes per byte sent.
+	If the compressor is slower, the level is lowered. If the uploads are slower, a higher level sends fewer bytes and
+	the level is raised. The level settles where both sides are balanced, which maximizes the logical rate.
+	"""
+
+	def __init__(self, upload_slots, min_level=MIN_LEVEL, max_level=MAX_LEVEL, start_level=START_LEVEL):
+		"""
+		:param upload_slots: number of parts of a file uploaded at the same time
+		:param min_level: lowest compression level to use
+		:param max_level: highest compression level to use
+		:param start_level: level of the first files, clamped to min_level and max_level
+		"""
+		self.upload_slots = upload_slots
+		self.min_level = min_level
+		self.max_level = max_level
+		self.level = min(max(start_level, min_level), max_level)
+		self.lock = threading.Lock()
+		self.upload_rate = None  # compressed bytes per second of a single part upload
+		self.compress_rates = {}  # level -> logical bytes per second of the compressor
+		self.ratios = {}  # level -> compression ratio
+
+	def record_upload(self, size, seconds):
+		"""
+		:param size: number of bytes of an uploaded part
+		:param seconds: duration of the upload, including retries
+		"""
+		if seconds <= 0:
+			return
+		with self.lock:
+			self.upload_rate = self._average(self.upload_rate, size / seconds)
+
+	def record_compression(self, level, logical_size, compressed_size, seconds):
+		"""
+		Record the compression of a file and adjust the level for the next files
+		:param level: compression level the file is compressed with
+		:param logical_size: size of the file
+		:param compressed_size: size of the compressed file
+		:param seconds: time spent reading and compressing the file
+		"""
+		if logical_size < MIN_SAMPLE_SIZE or compressed_size == 0 or seconds <= 0:
+			return
+		with self.lock:
+			self.compress_rates[level] = self._average(self.compress_rates.get(level), logical_size / seconds)
+			self.ratios[level] = self._average(self.ratios.get(level), logical_size / compressed_size)
+			if self.upload_rate is None or level != self.level:
+				return  # wait for a measurement of the current level
+			compress_rate = self.compress_rates[level]
+			network_rate = self.upload_rate * self.upload_slots * self.ratios[level]
+			new_level = self.level
+			if compress_rate < network_rate * (1 - HYSTERESIS):
+				new_level = max(self.min_level, self.level - 1)
+			elif compress_rate > network_rate * (1 + HYSTERESIS):
+				new_level = min(self.max_level, self.level + 1)
+			if new_level != self.level:
+				logging.info(
+					f"compression level {self.level} -> {new_level}, compressor {compress_rate / 1048576:.1f} MB/s, "
+					f"network {network_rate / 1048576:.1f} MB/s of file data")
+				self.level = new_level
+
+	@staticmethod
+	def _average(average, value):
+		"""
+		Exponential moving average
+		"""
+		if average is None:
+			return value
+		return SMOOTHING * value + (1 - SMOOTHING) * average
@@ -0,0 +1,184 @@
+import logging
+import os
+import stat
+import tarfile
+import tempfile
+import threading
+
+from glacier_rsync.compression import PLAIN
+from glacier_rsync.retrieval import aligned_range
+
+
+class BundleMember:
+	"""
+	A file packed into a bundle
+	"""
+
+	def __init__(self, path, file_size, mtime_ns, mtime, offset, length, compression, dict_id=None):
+		"""
+		:param path: absolute path of the file
+		:param file_size: size of the file
+		:param mtime_ns: modification time of the file in nanoseconds
+		:param mtime: modification time of the file
+		:param offset: position of the member data in the bundle
+		:param length: length of the member data in the bundle, compressed length if the member is compressed
+		:param compression: compression algorithm of the member data
+		:param dict_id: id of the dictionary the member is compressed with, None for no dictionary
+		"""
+		self.path = path
+		self.file_size = file_size
+		self.mtime_ns = mtime_ns
+		self.mtime = mtime
+		self.offset = offset
+		self.length = length
+		self.compression = compression
+		self.dict_id = dict_id
+		self.retrieval_start = None  # megabyte aligned range for ranged retrieval, set when the bundle is finalized
+		self.retrieval_end = None
+
+
+class Bundle:
+	"""
+	Tar archive of small files, buffered in a temporary file until it is uploaded
+	"""
+
+	def __init__(self):
+		self.file_object = tempfile.TemporaryFile(prefix="grsync-bundle-")
+		self.tar = tarfile.open(fileobj=self.file_object, mode="w", format=tarfile.PAX_FORMAT)
+		self.members = []
+		self.archive_size = None
+
+	@property
+	def size(self):
+		return self.file_object.tell()
+
+	def add(self, member, tarinfo, data):
+		"""
+		Append a file to the tar archive
+		:param member: BundleMember, offset is set when the member is written
+		:param tarinfo: tar header of the member
+		:param data: member data
+		"""
+		self.tar.addfile(tarinfo, _BytesReader(data))
+		# tar.offset is the end of the member data padded to the block size
+		blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+		if remainder > 0:
+			blocks += 1
+		member.offset = self.tar.offset - blocks * tarfile.BLOCKSIZE
+		self.members.append(member)
+
+	def finalize(self):
+		"""
+		Write the tar end of archive marker, calculate the member ranges and rewind the temporary file for uploading
+		"""
+		self.tar.close()
+		self.archive_size = self.file_object.tell()
+		self.file_object.seek(0)
+		for member in self.members:
+			member.retrieval_start, member.retrieval_end = aligned_range(
+				member.offset, member.length, self.archive_size)
+
+	def close(self):
+		self.file_object.close()
+
+
+class BundlePacker:
+	"""
+	Pack small files into tar bundles of a target size
+	Files can be added from several workers. The worker that fills a bundle gets it back for uploading.
+	"""
+
+	def __init__(self, bundle_size, codec=None, level=3, min_ratio=1.0):
+		"""
+		:param bundle_size: target size of a bundle in bytes
+		:param codec: Codec object to compress every member with, None for no compression
+		:param level: compression level
+		:param min_ratio: a member is stored uncompressed if its compression ratio is below this ratio
+		"""
+		self.bundle_size = bundle_size
+		self.codec = codec
+		self.level = level
+		self.min_ratio = min_ratio
+		self.dictionary = None  # zstd dictionary for members up to dictionary_max_file_size, set by the backup
+		self.dict_id = None
+		self.dictionary_max_file_size = 0
+		self.lock = threading.Lock()
+		self.bundle = None
+
+	def add(self, path, file_size, mtime_ns, mtime):
+		"""
+		Add a file to the current bundle
+		The file is read and compressed before taking the lock, only writing it to the bundle is serialized.
+		:return: the finalized bundle if it reached the target size, otherwise None
+		"""
+		with open(path, 'rb') as f:
+			tarinfo = self._tarinfo(path, os.fstat(f.fileno()))
+			data = f.read()
+		compression = PLAIN
+		dict_id = None
+		if self.codec is not None and data:
+			use_dictionary = self.dictionary is not None and len(data) <= self.dictionary_max_file_size
+			dictionary = self.dictionary if use_dictionary else None
+			compressed = self.codec.compress(data, self.level, dictionary=dictionary)
+			if len(data) >= len(compressed) * self.min_ratio:  # small files are compressed as a whole instead of probed
+				data = compressed
+				tarinfo.name += self.codec.extension
+				compression = self.codec.name
+				dict_id = self.dict_id if use_dictionary else None
+		tarinfo.size = len(data)
+		member = BundleMember(path, file_size, mtime_ns, mtime, None, len(data), compression, dict_id=dict_id)
+
+		with self.lock:
+			if self.bundle is None:
+				self.bundle = Bundle()
+			self.bundle.add(member, tarinfo, data)
+			if self.bundle.size < self.bundle_size:
+				return None
+			return self._take()
+
+	def flush(self):
+		"""
+		:return: the current bundle finalized, None if there is no file waiting to be uploaded
+		"""
+		with self.lock:
+			if self.bundle is None:
+				return None
+			return self._take()
+
+	def _take(self):
+		bundle = self.bundle
+		self.bundle = None
+		bundle.finalize()
+		logging.debug(f"bundle of {len(bundle.members)} files is ready, {bundle.archive_size} bytes")
+		return bundle
+
+	@staticmethod
+	def _tarinfo(path, stat_result):
+		"""
+		Tar header of a regular file
+		:param path: absolute path of the file
+		:param stat_result: os.stat_result of the file
+		"""
+		tarinfo = tarfile.TarInfo(path.lstrip("/"))
+		tarinfo.mode = stat.S_IMODE(stat_result.st_mode)
+		tarinfo.uid = stat_result.st_uid
+		tarinfo.gid = stat_result.st_gid
+		tarinfo.mtime = stat_result.st_mtime
+		return tarinfo
+
+
+class _BytesReader:
+	"""
+	Minimal file object over bytes for tarfile.addfile, avoids copying the data into a BytesIO
+	"""
+
+	def __init__(self, data):
+		self.view = memoryview(data)
+		self.pos = 0
+
+	def read(self, n=-1):
+		if n < 0:
+			n = len(self.view) - self.pos
+		chunk = self.view[self.pos:self.pos + n]
+		self.pos += len(chunk)
+		return chunk
@@ -0,0 +1,79 @@
+import logging
+import os
+import threading
+
+LEARN_SAMPLES = 8  # number of probes after which a unanimous extension is not probed anymore
+LEARN_MIN_SIZE = 64 * 1024  # smaller files do not compress because of the frame overhead, they are not counted
+
+
+class CompressionProbe:
+	"""
+	Decide whether a file is worth compressing
+	The first probe_size bytes of a file are compressed, the file is uploaded uncompressed if the ratio is below
+	min_ratio. Results are counted per file extension in the catalog. Once LEARN_SAMPLES files of an extension had the
+	same result, files with that extension are decided without probing. Files smaller than LEARN_MIN_SIZE are always
+	probed.
+	"""
+
+	def __init__(self, catalog, codec, probe_size, min_ratio, level=3):
+		"""
+		:param catalog: Catalog object storing the per extension results
+		:param codec: Codec object the files are compressed with
+		:param probe_size: number of bytes compressed at the beginning of a file
+		:param min_ratio: minimum compression ratio of the probe for compressing the file
+		:param level: compression level of the probe
+		"""
+		self.catalog = catalog
+		self.codec = codec
+		self.probe_size = probe_size
+		self.min_ratio = min_ratio
+		self.level = level
+		self.lock = threading.Lock()
+		self.extensions = catalog.get_extension_stats()  # extension -> [samples, incompressible samples]
+
+	def should_compress(self, path, dictionary=None):
+		"""
+		:param path: absolute path of the file
+		:param dictionary: dictionary the file would be compressed with
+		:return: True if the file should be compressed
+		"""
+		extension = self.extension(path)
+		with self.lock:
+			samples, incompressible = self.extensions.get(extension, (0, 0))
+		if samples >= LEARN_SAMPLES and incompressible in (0, samples):
+			return incompressible == 0
+
+		compressible, sample_size = self._probe(path, dictionary)
+		if sample_size < LEARN_MIN_SIZE:
+			return compressible
+		with self.lock:
+			stats = self.extensions.setdefault(extension, [0, 0])
+			stats[0] += 1
+			if not compressible:
+				stats[1] += 1
+			samples, incompressible = stats
+			self.catalog.set_extension_stats(extension, samples, incompressible)  # under the lock to keep the order
+		if samples == LEARN_SAMPLES and incompressible in (0, samples):
+			logging.info(f"'{extension}' files are {'' if incompressible == 0 else 'not '}compressed from now on")
+		return compressible
+
+	def _probe(self, path, dictionary=None):
+		"""
+		Compress the beginning of a file
+		:return: tuple(True if the compression ratio is at least min_ratio, number of bytes probed)
+		"""
+		with open(path, 'rb') as f:
+			sample = f.read(self.probe_size)
+		if not sample:
+			return False, 0  # nothing to gain on an empty file
+		compressed = self.codec.compress(sample, self.level, dictionary=dictionary)
+		ratio = len(sample) / len(compressed)
+		logging.debug(f"{path} compression ratio of the first {len(sample)} bytes is {ratio:.2f}")
+		return ratio >= self.min_ratio, len(sample)
+
+	@staticmethod
+	def extension(path):
+		"""
+		:return: lower case extension of a file including the dot, empty string if there is none
+		"""
+		return os.path.splitext(path)[1].lower()
@@ -0,0 +1,584 @@
+import logging
+import os
+import shutil
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+from glacier_rsync.catalog import Catalog
+from glacier_rsync.compression import get_codec
+from glacier_rsync.dictionary import load_dictionary
+from glacier_rsync.retrieval import is_tree_hash_aligned, retrieval_byte_range
+from glacier_rsync.retry import CLIENT_CONFIG, RetryPolicy
+from glacier_rsync.seekable import FrameWriter
+from glacier_rsync.stats import RunStats
+from glacier_rsync.tree_hash import ChecksumMismatchError, total_tree_hash, tree_hash
+
+JOB_LIFETIME = 23 * 60 * 60  # glacier keeps the output of a job for 24 hours, leave a margin
+STAGING_FOLDER = ".grsync-restore"
+
+
+class Retrieval:
+	"""
+	A retrieval job of an archive or a byte range of an archive, and the files restored from its output
+	"""
+
+	def __init__(self, archive_id, range_start=None, range_end=None):
+		self.archive_id = archive_id
+		self.range_start = range_start
+		self.range_end = range_end
+		self.items = []
+		self.job_id = None
+
+
+class RestoreUtil:
+	def __init__(self, args):
+		self.continue_running = True
+
+		self.dest = os.path.abspath(args.dest)
+		self.prefix = args.path
+		self.tier = args.tier
+		self.job_batch_size = args.job_batch_size
+		self.poll_interval = args.poll_interval
+		self.download_concurrency = args.download_concurrency
+		self.chunk_size = args.chunk_size
+		self.staging_dir = os.path.join(self.dest, STAGING_FOLDER)
+
+		self.vault = args.vault
+		self.region = args.region
+
+		self.glacier = boto3.client("glacier", region_name=self.region, config=CLIENT_CONFIG)
+		self.decompress_workers = args.decompress_workers
+		self.decompress_executor = ThreadPoolExecutor(
+			max_workers=self.decompress_workers, thread_name_prefix="grsync-decompress")
+		self.stats = RunStats()
+		self.retry = RetryPolicy(
+			args.max_throttling_retries, args.max_server_retries, args.retry_base_delay, args.retry_max_delay,
+			self.stats)
+
+		self.catalog = Catalog(args.db)
+		self.dictionaries = {}  # dict id -> loaded compression dictionary
+		logging.debug("init is done")
+
+	def stop(self):
+		"""
+		Set break condition for the job loop
+		Utility will exit as soon as current downloads are complete.
+		"""
+		self.continue_running = False
+
+	def close(self):
+		"""
+		Close database connection
+		"""
+		self.decompress_executor.shutdown(wait=False)
+		self.catalog.close()
+
+	def restore(self):
+		"""
+		Interface function to retrieve the backed up files and write them under the destination folder
+		"""
+		items = [item for item in self.catalog.get_restore_items(self.prefix) if not self._is_restored(item)]
+		retrievals = self._group(items)
+		logging.info(f"number of files to restore: {len(items)}, number of retrieval jobs: {len(retrievals)}")
+		os.makedirs(self.staging_dir, exist_ok=True)
+
+		pending = deque(retrievals)
+		active = {}  # job id -> Retrieval
+		while (pending or active) and self.continue_running:
+			while pending and len(active) < self.job_batch_size:  # keep a batch of jobs in progress
+				retrieval = pending.popleft()
+				if self._initiate_job(retrieval):
+					active[retrieval.job_id] = retrieval
+
+			completed_jobs = self._poll_jobs(active)
+			for job in completed_jobs:
+				if not self.continue_running:
+					break
+				retrieval = active.pop(job["JobId"])
+				self._complete_job(retrieval, job)
+
+			if not completed_jobs and active:
+				logging.info(f"waiting for {len(active)} retrieval jobs, {len(pending)} jobs are not started yet")
+				self._sleep(self.poll_interval)
+
+		if not self.continue_running:
+			logging.info(f"Exiting early...")
+		logging.info("All files are processed.")
+		self.stats.log_summary()
+		self.close()
+
+	def _is_restored(self, item):
+		"""
+		Check if a file is already restored by an earlier run
+		Restored files get their original modification time, so size and mtime are compared like a backup does.
+		"""
+		try:
+			stat = os.stat(self._target_path(item.path))
+		except OSError:
+			return False
+		if item.mtime_ns is not None:
+			return stat.st_size == item.file_size and stat.st_mtime_ns == item.mtime_ns
+		return stat.st_size == item.file_size and stat.st_mtime == item.mtime
+
+	@staticmethod
+	def _group(items):
+		"""
+		Group files into retrievals
+		Every archive is retrieved as a whole. Bundle members are retrieved with ranged retrievals, overlapping or
+		adjacent ranges of the same bundle are merged into a single job.
+		:param items: list of RestoreItem
+		:return: list of Retrieval
+		"""
+		retrievals = {}
+		members = {}
+		for item in items:
+			if item.offset is None:
+				retrievals.setdefault(item.archive_id, Retrieval(item.archive_id)).items.append(item)
+			else:
+				members.setdefault(item.archive_id, []).append(item)
+
+		result = list(retrievals.values())
+		for archive_id, bundle_members in members.items():
+			bundle_members.sort(key=lambda member: member.retrieval_start)
+			current = None
+			for member in bundle_members:
+				if current is None or member.retrieval_start > current.range_end + 1:
+					current = Retrieval(archive_id, member.retrieval_start, member.retrieval_end)
+					result.append(current)
+				current.range_end = max(current.range_end, member.retrieval_end)
+				current.items.append(member)
+		return result
+
+	def _initiate_job(self, retrieval):
+		"""
+		Start a retrieval job, a job of an earlier run is reused if its output is still available
+		:param retrieval: Retrieval object, job_id is set
+		:return: True if the job is started
+		"""
+		job = self.catalog.get_restore_job(retrieval.archive_id, retrieval.range_start, retrieval.range_end)
+		if job is not None:
+			job_id, created = job
+			if time.time() - created < JOB_LIFETIME:
+				try:
+					response = self.retry.call(self.glacier.describe_job, vaultName=self.vault, jobId=job_id)
+					if response["StatusCode"] != "Failed":
+						logging.debug(f"reusing retrieval job {job_id}")
+						retrieval.job_id = job_id
+						return True
+				except (ClientError, BotoCoreError) as e:
+					logging.info(f"retrieval job {job_id} is not available anymore: {str(e)}")
+			self._forget_job(job_id)
+
+		job_parameters = {"Type": "archive-retrieval", "ArchiveId": retrieval.archive_id, "Tier": self.tier}
+		if retrieval.range_start is not None:
+			job_parameters["RetrievalByteRange"] = retrieval_byte_range(retrieval.range_start, retrieval.range_end)
+		try:
+			response = self.retry.call(
+				self.glacier.initiate_job, vaultName=self.vault, jobParameters=job_parameters)
+		except (ClientError, BotoCoreError) as e:
+			logging.error(f"Cannot start retrieval job for archive {retrieval.archive_id}: {str(e)}")
+			self.stats.increment("files_failed", len(retrieval.items))
+			return False
+		retrieval.job_id = response["jobId"]
+		self.catalog.add_restore_job(
+			retrieval.job_id, retrieval.archive_id, retrieval.range_start, retrieval.range_end, int(time.time()))
+		self.stats.increment("jobs_initiated")
+		return True
+
+	def _poll_jobs(self, active):
+		"""
+		Find completed jobs with a single paginated list_jobs call instead of describing every job
+		:param active: dict(job id -> Retrieval)
+		:return: list of job descriptions of the completed active jobs
+		"""
+		completed_jobs = []
+		try:
+			marker = None
+			while True:
+				kwargs = {"marker": marker} if marker is not None else {}
+				response = self.retry.call(
+					self.glacier.list_jobs, vaultName=self.vault, completed="true", **kwargs)
+				completed_jobs.extend(job for job in response["JobList"] if job["JobId"] in active)
+				marker = response.get("Marker")
+				if not marker:
+					break
+		except (ClientError, BotoCoreError) as e:
+			logging.error(f"Cannot list retrieval jobs: {str(e)}")
+		return completed_jobs
+
+	def _complete_job(self, retrieval, job):
+		"""
+		Download the output of a completed job and write the files
+		:param retrieval: Retrieval object
+		:param job: job description
+		"""
+		if job["StatusCode"] != "Succeeded":
+			logging.error(f"retrieval job of archive {retrieval.archive_id} failed: {job.get('StatusMessage')}")
+			self.stats.increment("jobs_failed")
+			self.stats.increment("files_failed", len(retrieval.items))
+			self._forget_job(retrieval.job_id)
+			return
+
+		staging_path = os.path.join(self.staging_dir, f"{retrieval.job_id}.part")
+		try:
+			if retrieval.range_start is None:
+				if not self._stream(retrieval, job):
+					return  # stopped, the job is reused by the next run
+			else:
+				if not self._download(retrieval, job, staging_path):
+					return  # stopped, the job is reused by the next run
+				for item in retrieval.items:
+					self._write_file(retrieval, item, staging_path)
+		except (ClientError, BotoCoreError, ChecksumMismatchError) as e:
+			logging.error(f"Error restoring archive {retrieval.archive_id}: {str(e)}")
+			self.stats.increment("files_failed", len(retrieval.items))
+			if isinstance(e, ChecksumMismatchError):  # corrupt output is downloaded again in the next run
+				self.catalog.clear_restore_chunks(retrieval.job_id)
+				self._remove(staging_path)
+			return
+		self._forget_job(retrieval.job_id)
+
+	def _download(self, retrieval, job, path):
+		"""
+		Download the job output into a file in parallel byte ranges
+		Every downloaded range is persisted, an interrupted download continues from the missing ranges.
+		:param retrieval: Retrieval object
+		:param job: job description
+		:param path: file to write the job output to
+		:return: False if a stop is requested before the download is complete
+		"""
+		if retrieval.range_start is not None:
+			output_size = retrieval.range_end + 1 - retrieval.range_start
+		else:
+			output_size = job["ArchiveSizeInBytes"]
+
+		downloaded = self.catalog.get_restore_chunks(retrieval.job_id)
+		if downloaded and not os.path.exists(path):
+			self.catalog.clear_restore_chunks(retrieval.job_id)
+			downloaded = {}
+		with open(path, "ab") as f:  # create the file without truncating a partial download
+			f.truncate(output_size)
+			self._preallocate(f, output_size)
+
+		chunks = self._chunks(output_size)
+		logging.info(
+			f"downloading {output_size} bytes of archive {retrieval.archive_id}, "
+			f"{len(downloaded)}/{len(chunks)} ranges are already downloaded")
+
+		fd = os.open(path, os.O_WRONLY)
+		try:
+			with ThreadPoolExecutor(max_workers=self.download_concurrency) as executor:
+				futures = [
+					executor.submit(self._download_chunk, retrieval.job_id, fd, range_start, range_end, output_size)
+					if range_start not in downloaded else None
+					for range_start, range_end in chunks
+				]
+				try:
+					checksums = []
+					for future, (range_start, _) in zip(futures, chunks):
+						if not self.continue_running:
+							return False  # the ranges in progress are persisted, the job is reused by the next run
+						checksums.append(future.result() if future is not None else downloaded[range_start][1])
+				finally:
+					for future in futures:
+						if future is not None:
+							future.cancel()
+		finally:
+			os.close(fd)
+
+		# ranges are a power of two megabytes, their tree hashes are nodes of the tree of the whole output
+		local_tree_hash = total_tree_hash(checksums)
+		if job.get("SHA256TreeHash") and job["SHA256TreeHash"] != local_tree_hash:
+			raise ChecksumMismatchError(
+				f"job output checksum {job['SHA256TreeHash']} does not match the local checksum {local_tree_hash}")
+		return True
+
+	def _stream(self, retrieval, job):
+		"""
+		Download the output of a whole archive job straight into the restored file, nothing is staged
+		A plain archive is the file itself, it is downloaded in place like a staged output. A compressed archive is
+		decompressed while the next ranges are downloaded.
+		:param retrieval: Retrieval object
+		:param job: job description
+		:return: False if a stop is requested before the file is complete
+		"""
+		item = retrieval.items[0]
+		target = self._target_path(item.path)
+		os.makedirs(os.path.dirname(target), exist_ok=True)
+		temp_target = f"{target}.grsync-tmp"
+		codec = get_codec(item.compression)
+		try:
+			if codec is None:
+				if not self._download(retrieval, job, temp_target):
+					return False
+				restored_size = os.path.getsize(temp_target)
+			else:
+				restored_size = self._decompress_stream(retrieval, job, codec, temp_target)
+				if restored_size is None:
+					return False
+			if restored_size != item.file_size:
+				raise ChecksumMismatchError(
+					f"{item.path} is restored with {restored_size} bytes instead of {item.file_size}")
+		except ChecksumMismatchError:
+			self._remove(temp_target)
+			raise
+
+		self._finish_file(temp_target, target, item)
+		for duplicate in retrieval.items[1:]:  # several paths backed up by the same archive
+			duplicate_target = self._target_path(duplicate.path)
+			os.makedirs(os.path.dirname(duplicate_target), exist_ok=True)
+			shutil.copyfile(target, f"{duplicate_target}.grsync-tmp")
+			self._finish_file(f"{duplicate_target}.grsync-tmp", duplicate_target, duplicate)
+		return True
+
+	def _decompress_stream(self, retrieval, job, codec, temp_target):
+		"""
+		Download a compressed archive and decompress it into the restored file
+		Ranges are downloaded in parallel and consumed in order, at most download_concurrency ranges are held in memory.
+		The frames of a seekable archive are written in place, a range is persisted once every frame starting in it is
+		written, so an interrupted restore continues from the first missing range. Other archives are a single stream
+		and are downloaded again from the start.
+		:param retrieval: Retrieval object
+		:param job: job description
+		:param codec: Codec object of the archive
+		:param temp_target: file to write the restored file to
+		:return: size of the restored file, None if a stop is requested before the file is complete
+		"""
+		item = retrieval.items[0]
+		output_size = job["ArchiveSizeInBytes"]
+		chunks = self._chunks(output_size)
+		frames = self.catalog.get_frames(retrieval.archive_id)
+		downloaded = self.catalog.get_restore_chunks(retrieval.job_id) if frames else {}
+		first = 0  # ranges before it are persisted and all their frames are written
+		if os.path.exists(temp_target):
+			while first < len(chunks) and downloaded.get(chunks[first][0], (None,))[0] == chunks[first][1]:
+				first += 1
+		if first == 0 and downloaded:
+			self.catalog.clear_restore_chunks(retrieval.job_id)
+		checksums = [downloaded[range_start][1] for range_start, _ in chunks[:first]]
+		logging.info(
+			f"streaming {output_size} bytes of archive {retrieval.archive_id} to {temp_target}, "
+			f"{first}/{len(chunks)} ranges are already restored")
+
+		with open(temp_target, "r+b" if first else "wb") as dst, \
+			ThreadPoolExecutor(max_workers=self.download_concurrency) as executor:
+			if first == 0:
+				self._preallocate(dst, item.file_size)
+			if frames:  # independent frames are decompressed in parallel
+				position = chunks[first][0] if first < len(chunks) else output_size
+				writer = FrameWriter(
+					dst, frames, codec, self.decompress_executor, self.decompress_workers, position=position)
+			else:
+				writer = codec.writer(dst, dictionary=self._dictionary(item.dict_id))
+
+			pending = deque(chunks[first:])
+			in_flight = deque()
+			consumed = deque()  # tuple(range start, range end, checksum) of consumed ranges, not persisted yet
+			try:
+				while (pending or in_flight) and self.continue_running:
+					while pending and len(in_flight) < self.download_concurrency:
+						range_start, range_end = pending.popleft()
+						in_flight.append((
+							range_start, range_end,
+							executor.submit(self._fetch_chunk, retrieval.job_id, range_start, range_end, output_size)))
+					range_start, range_end, future = in_flight.popleft()
+					data, checksum = future.result()
+					writer.write(data)
+					checksums.append(checksum)
+					if frames:
+						consumed.append((range_start, range_end, checksum))
+						self._persist_chunks(retrieval.job_id, consumed, writer.completed())
+				if len(checksums) == len(chunks):
+					writer.close()
+			finally:
+				for _, _, future in in_flight:
+					future.cancel()
+				if frames:
+					writer.abort()  # frames being decompressed still write to the file
+					self._persist_chunks(retrieval.job_id, consumed, writer.completed())
+			if len(checksums) == len(chunks):
+				restored_size = dst.tell()
+				dst.truncate(restored_size)
+
+		if len(checksums) < len(chunks):
+			if not frames:
+				self._remove(temp_target)
+			return None
+		local_tree_hash = total_tree_hash(checksums)
+		if job.get("SHA256TreeHash") and job["SHA256TreeHash"] != local_tree_hash:
+			raise ChecksumMismatchError(
+				f"job output checksum {job['SHA256TreeHash']} does not match the local checksum {local_tree_hash}")
+		return restored_size
+
+	def _persist_chunks(self, job_id, consumed, completed_offset):
+		"""
+		Persist the consumed ranges of a seekable archive in order, once every frame starting in them is written
+		:param job_id: retrieval job id
+		:param consumed: deque of tuple(range start, range end, checksum) of the consumed ranges not persisted yet
+		:param completed_offset: position in the archive, every frame starting before it is written
+		"""
+		while consumed and consumed[0][1] < completed_offset:
+			self.catalog.add_restore_chunk(job_id, *consumed.popleft())
+
+	def _chunks(self, output_size):
+		"""
+		:return: list of tuple(range start, range end) of the download ranges of a job output
+		"""
+		return [
+			(range_start, min(range_start + self.chunk_size, output_size) - 1)
+			for range_start in range(0, output_size, self.chunk_size)
+		]
+
+	@staticmethod
+	def _preallocate(f, size):
+		"""
+		Reserve disk space for a restored file, so a full disk fails before the download and the file is not fragmented
+		:param f: file object opened for writing
+		:param size: size of the restored file
+		"""
+		if size <= 0:
+			return
+		try:
+			os.posix_fallocate(f.fileno(), 0, size)
+		except (AttributeError, OSError):  # not supported by the platform or the file system
+			pass
+
+	def _download_chunk(self, job_id, fd, range_start, range_end, output_size):
+		"""
+		Download a byte range of a job output and write it to its position in the staging file
+		:return: tree hash of the range
+		"""
+		data, local_tree_hash = self._fetch_chunk(job_id, range_start, range_end, output_size)
+		os.pwrite(fd, data, range_start)
+		self.catalog.add_restore_chunk(job_id, range_start, range_end, local_tree_hash)
+		return local_tree_hash
+
+	def _fetch_chunk(self, job_id, range_start, range_end, output_size):
+		"""
+		Download a byte range of a job output and verify it
+		Glacier returns the checksum of tree hash aligned ranges only, the tree hash of every range is still verified as
+		part of the tree hash of the whole output.
+		:param output_size: size of the job output
+		:return: tuple(data, tree hash of the range)
+		"""
+		def fetch():
+			response = self.glacier.get_job_output(
+				vaultName=self.vault, jobId=job_id, range=f"bytes={range_start}-{range_end}")
+			return response["body"].read(), response.get("checksum")
+
+		data, checksum = self.retry.call(fetch)
+		if len(data) != range_end + 1 - range_start:
+			raise ChecksumMismatchError(f"range {range_start}-{range_end} is incomplete, {len(data)} bytes received")
+		local_tree_hash = tree_hash(data)
+		if is_tree_hash_aligned(range_start, range_end, output_size):
+			if checksum is None:
+				logging.warning(f"no checksum is returned for the aligned range {range_start}-{range_end}")
+			elif checksum != local_tree_hash:
+				raise ChecksumMismatchError(
+					f"range {range_start}-{range_end} checksum {checksum} does not match the local checksum "
+					f"{local_tree_hash}")
+		self.stats.increment("bytes_downloaded", len(data))
+		return data, local_tree_hash
+
+	def _write_file(self, retrieval, item, staging_path):
+		"""
+		Write a restored file from the downloaded job output, decompress it if it is compressed
+		:param retrieval: Retrieval object
+		:param item: RestoreItem
+		:param staging_path: downloaded job output
+		"""
+		target = self._target_path(item.path)
+		os.makedirs(os.path.dirname(target), exist_ok=True)
+		temp_target = f"{target}.grsync-tmp"
+
+		with open(staging_path, "rb") as src:
+			src.seek(item.offset - retrieval.range_start)
+			reader = _LimitedReader(src, item.length)
+			with open(temp_target, "wb") as dst:
+				codec = get_codec(item.compression)
+				if codec is not None:
+					writer = codec.writer(dst, dictionary=self._dictionary(item.dict_id))
+					shutil.copyfileobj(reader, writer)
+					writer.close()
+				else:
+					shutil.copyfileobj(reader, dst)
+
+		self._finish_file(temp_target, target, item)
+
+	def _dictionary(self, dict_id):
+		"""
+		:param dict_id: id of the dictionary a file is compressed with, None for no dictionary
+		:return: compression dictionary, None if dict_id is None
+		"""
+		if dict_id is None:
+			return None
+		if dict_id not in self.dictionaries:
+			stored = self.catalog.get_dictionary(dict_id)
+			if stored is None:
+				logging.error(f"compression dictionary {dict_id} is not in the database")
+				sys.exit(3)
+			self.dictionaries[dict_id] = load_dictionary(stored[1])
+		return self.dictionaries[dict_id]
+
+	def _finish_file(self, temp_target, target, item):
+		"""
+		Move a completely written file to its place and set its original modification time
+		"""
+		os.replace(temp_target, target)
+		if item.mtime_ns is not None:
+			os.utime(target, ns=(item.mtime_ns, item.mtime_ns))
+		else:
+			os.utime(target, (item.mtime, item.mtime))
+		logging.info(f"{item.path} is restored to {target}")
+		self.stats.increment("files_restored")
+
+	def _target_path(self, path):
+		"""
+		:param path: absolute path of the backed up file
+		:return: path of the restored file under the destination folder
+		"""
+		return os.path.join(self.dest, path.lstrip(os.sep))
+
+	def _forget_job(self, job_id):
+		"""
+		Remove the state and the staging file of a job
+		"""
+		self.catalog.finish_restore_job(job_id)
+		self._remove(os.path.join(self.staging_dir, f"{job_id}.part"))
+
+	@staticmethod
+	def _remove(path):
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			pass
+
+	def _sleep(self, seconds):
+		"""
+		Sleep, wake up early if a stop is requested
+		"""
+		deadline = time.monotonic() + seconds
+		while self.continue_running and time.monotonic() < deadline:
+			time.sleep(min(1.0, deadline - time.monotonic()))
+
+
+class _LimitedReader:
+	"""
+	Read at most n bytes of a file object
+	"""
+
+	def __init__(self, f, n):
+		self.f = f
+		self.remaining = n
+
+	def read(self, size=-1):
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.f.read(size)
+		self.remaining -= len(data)
+		return data
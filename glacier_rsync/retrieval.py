@@ -0,0 +1,46 @@
+from glacier_rsync.tree_hash import TREE_HASH_CHUNK_SIZE
+
+
+def aligned_range(offset, length, archive_size):
+	"""
+	Smallest megabyte aligned byte range of an archive covering the given data
+	Glacier accepts ranged retrievals only on megabyte boundaries, the end of the range may also be the end of the
+	archive.
+	:param offset: position of the data in the archive
+	:param length: length of the data
+	:param archive_size: size of the archive
+	:return: tuple(first byte, last byte) of the range, both inclusive
+	"""
+	start = offset // TREE_HASH_CHUNK_SIZE * TREE_HASH_CHUNK_SIZE
+	end = -(-(offset + max(length, 1)) // TREE_HASH_CHUNK_SIZE) * TREE_HASH_CHUNK_SIZE
+	return start, min(end, archive_size) - 1
+
+
+def is_tree_hash_aligned(start, end, archive_size):
+	"""
+	Check if a range is tree hash aligned, glacier returns the tree hash of a retrieval only for such ranges
+	A range is tree hash aligned if it is a node of the archive's hash tree: 2^n megabytes starting at a multiple of
+	2^n megabytes, truncated at the end of the archive.
+	:param start: first byte of the range
+	:param end: last byte of the range, inclusive
+	:param archive_size: size of the archive
+	:return: True if the range is tree hash aligned
+	"""
+	if start % TREE_HASH_CHUNK_SIZE != 0:
+		return False
+	if start == 0 and end == archive_size - 1:
+		return True
+	chunk_count = -(-(end + 1 - start) // TREE_HASH_CHUNK_SIZE)
+	block_size = TREE_HASH_CHUNK_SIZE
+	while block_size < chunk_count * TREE_HASH_CHUNK_SIZE:
+		block_size *= 2
+	if start % block_size != 0:
+		return False
+	return end + 1 == start + block_size or end == archive_size - 1
+
+
+def retrieval_byte_range(start, end):
+	"""
+	:return: RetrievalByteRange parameter of initiate_job
+	"""
+	return f"{start}-{end}"
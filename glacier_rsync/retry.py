@@ -0,0 +1,99 @@
+import logging
+import random
+import time
+
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+THROTTLING_ERROR_CODES = {
+	"Throttling",
+	"ThrottlingException",
+	"ThrottledException",
+	"RequestThrottledException",
+	"TooManyRequestsException",
+	"RequestLimitExceeded",
+	"SlowDown",
+}
+
+SERVER_ERROR_CODES = {
+	"InternalFailure",
+	"InternalError",
+	"ServiceUnavailableException",
+	"RequestTimeoutException",
+}
+
+THROTTLING = "throttling"
+SERVER_ERROR = "server_error"
+
+# RetryPolicy is the only retry layer, botocore retrying as well would multiply the attempts and delays
+CLIENT_CONFIG = Config(retries={"total_max_attempts": 1})
+
+
+class RetryPolicy:
+	"""
+	Retry glacier requests with exponential backoff and full jitter
+	Throttling and server errors have separate retry budgets. Other errors are raised immediately.
+	"""
+
+	def __init__(self, max_throttling_retries, max_server_retries, base_delay, max_delay, stats):
+		"""
+		:param max_throttling_retries: maximum number of retries of a single request after throttling errors
+		:param max_server_retries: maximum number of retries of a single request after server or connection errors
+		:param base_delay: delay in seconds before the first retry
+		:param max_delay: upper bound of the delay in seconds
+		:param stats: RunStats object to count the retries
+		"""
+		self.budgets = {THROTTLING: max_throttling_retries, SERVER_ERROR: max_server_retries}
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.stats = stats
+
+	def call(self, func, *args, **kwargs):
+		"""
+		Call a function and retry it on retryable errors
+		:param func: function that sends a request
+		:return: return value of the function
+		"""
+		attempts = {THROTTLING: 0, SERVER_ERROR: 0}
+		while True:
+			try:
+				return func(*args, **kwargs)
+			except (ClientError, ConnectionError, HTTPClientError) as e:
+				error_type = self.classify(e)
+				if error_type is None:
+					raise
+				if attempts[error_type] >= self.budgets[error_type]:
+					self.stats.increment(f"{error_type}_retries_exhausted")
+					raise
+				attempts[error_type] += 1
+				self.stats.increment(f"{error_type}_retries")
+				delay = self.backoff(attempts[error_type])
+				logging.warning(
+					f"{error_type} error, retry {attempts[error_type]}/{self.budgets[error_type]} "
+					f"in {delay:.1f} seconds: {str(e)}")
+				time.sleep(delay)
+
+	def backoff(self, attempt):
+		"""
+		Full jitter backoff, a random delay between 0 and the exponential upper bound
+		:param attempt: 1 based retry number
+		:return: delay in seconds
+		"""
+		return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+	@staticmethod
+	def classify(error):
+		"""
+		Decide if an error is retryable
+		:param error: exception raised by botocore
+		:return: THROTTLING, SERVER_ERROR or None if the error should not be retried
+		"""
+		if not isinstance(error, ClientError):
+			return SERVER_ERROR  # connection errors and timeouts
+		code = error.response.get("Error", {}).get("Code")
+		status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+		if code in THROTTLING_ERROR_CODES or status == 429:
+			return THROTTLING
+		if code in SERVER_ERROR_CODES or status >= 500:
+			return SERVER_ERROR
+		return None
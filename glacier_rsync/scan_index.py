@@ -0,0 +1,117 @@
+import logging
+import os
+import time
+
+from glacier_rsync.scanner import ScanEntry
+
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000  # directories modified this close to their listing are listed again next time
+
+
+class ScanIndex:
+	"""
+	Walk the source tree using the directory snapshot of the previous run
+	The entries of every listed directory are stored in the catalog with the modification time of the directory. Adding,
+	removing or renaming an entry changes the modification time of its directory, so a directory with the same
+	modification time is not listed again, its stored entries are used instead. Files of an unchanged directory that are
+	already backed up with their stored size and modification time are not even stat'ed, so files modified in place
+	without touching their directory are not detected. This is the trust that --trust-dir-mtime asks for.
+	"""
+
+	def __init__(self, catalog, stats):
+		"""
+		:param catalog: Catalog object storing the snapshot
+		:param stats: RunStats object
+		"""
+		self.catalog = catalog
+		self.stats = stats
+
+	def walk(self, top):
+		"""
+		Walk the directory tree, the order of the files is the same as Scanner.walk
+		:param top: absolute path of the root directory
+		:return: generator of ScanEntry
+		"""
+		stack = [top]
+		while stack:
+			directory = stack.pop()
+			try:
+				mtime_ns = os.stat(directory).st_mtime_ns  # taken before the listing, a later change is seen next time
+			except OSError as e:
+				logging.warning(f"cannot stat directory {directory}: {str(e)}")
+				continue
+			stored = self.catalog.get_scan_directory(directory)
+			unchanged = stored is not None and stored[0] == mtime_ns
+			if unchanged:
+				entries = stored[1]
+				self.stats.increment("directories_not_listed")
+			else:
+				entries = self._list(directory)
+				if entries is None:
+					continue
+				previous = stored[1] if stored is not None else []
+				self._store(directory, mtime_ns, entries, previous)
+
+			dirs = []
+			for name, is_dir, file_size, file_mtime_ns, file_mtime in entries:
+				path = os.path.join(directory, name)
+				if is_dir:
+					dirs.append(path)
+				elif not unchanged:
+					if file_size is not None:  # files that cannot be stat'ed are logged by the listing
+						yield ScanEntry(path, file_size, file_mtime_ns, file_mtime)
+				elif file_mtime is not None and \
+					self.catalog.is_backed_up(path, file_size, file_mtime_ns, file_mtime):
+					self.stats.increment("files_trusted")
+				else:
+					# a file that failed in an earlier run or stored by an older version, it is stat'ed again since
+					# the stored stats can be old
+					try:
+						scan_entry = ScanEntry.from_stat(path, os.stat(path))
+					except OSError as e:
+						logging.warning(f"cannot stat {path}: {str(e)}")
+						continue
+					yield scan_entry
+			stack.extend(reversed(dirs))  # visit sub directories in listing order
+
+	@staticmethod
+	def _list(directory):
+		"""
+		List a directory and stat its files
+		:return: list of tuple(name, is directory, file size, file modification time in nanoseconds, file modification
+			time in seconds), None if the directory cannot be listed
+		"""
+		entries = []
+		try:
+			with os.scandir(directory) as it:
+				for entry in it:
+					try:
+						is_dir = entry.is_dir()
+					except OSError:
+						is_dir = False
+					if is_dir:
+						if not entry.is_symlink():
+							entries.append((entry.name, True, None, None, None))
+						continue
+					try:
+						entry_stat = entry.stat()
+					except OSError as e:
+						logging.warning(f"cannot stat {entry.path}: {str(e)}")
+						entries.append((entry.name, False, None, None, None))
+						continue
+					entries.append((entry.name, False, entry_stat.st_size, entry_stat.st_mtime_ns, entry_stat.st_mtime))
+		except OSError as e:
+			logging.warning(f"cannot list directory {directory}: {str(e)}")
+			return None
+		return entries
+
+	def _store(self, directory, mtime_ns, entries, previous):
+		"""
+		Replace the snapshot of a listed directory
+		:param previous: entries of the previous snapshot, snapshots of removed sub directories are deleted
+		"""
+		if mtime_ns >= time.time_ns() - RACY_WINDOW_NS:
+			# an entry added in the same timestamp tick would not change the modification time
+			mtime_ns = None
+		names = {name for name, is_dir, *_ in entries if is_dir}
+		removed = [os.path.join(directory, name) for name, is_dir, *_ in previous if is_dir and name not in names]
+		self.catalog.set_scan_directory(directory, mtime_ns, entries, removed)
@@ -0,0 +1,157 @@
+import logging
+import os
+import queue
+import threading
+
+_END_OF_SCAN = None
+
+
+class ScanEntry:
+	"""
+	A discovered file with its stats, taken with a single stat call while scanning
+	The same stats are used to check whether the file is backed up and to store it in the catalog.
+	"""
+	__slots__ = ("path", "size", "mtime_ns", "mtime")
+
+	def __init__(self, path, size, mtime_ns, mtime):
+		"""
+		:param path: absolute path of the file
+		:param size: size of the file
+		:param mtime_ns: modification time of the file in nanoseconds
+		:param mtime: modification time of the file
+		"""
+		self.path = path
+		self.size = size
+		self.mtime_ns = mtime_ns
+		self.mtime = mtime
+
+	@classmethod
+	def from_stat(cls, path, stat_result):
+		"""
+		:param path: absolute path of the file
+		:param stat_result: os.stat_result of the file
+		:return: ScanEntry object
+		"""
+		return cls(path, stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_mtime)
+
+
+class Scanner:
+	"""
+	Walk the source tree in a background thread and stream the found files through a bounded queue
+	Files can be consumed as soon as they are discovered, the complete file list is never kept in memory.
+	"""
+
+	def __init__(self, src, queue_size=10000, walk=None):
+		"""
+		:param src: file or folder to back up
+		:param queue_size: maximum number of discovered files waiting to be consumed
+		:param walk: function walking a directory tree into ScanEntry objects like ScanIndex.walk or
+			ParallelWalker.walk, None for Scanner.walk
+		"""
+		self.src = src
+		self.walk_tree = walk if walk is not None else self.walk
+		self.queue = queue.Queue(maxsize=queue_size)
+		self.discovered = 0
+		self.done = False
+		self.continue_running = True
+		self.thread = threading.Thread(target=self._produce, name="grsync-scanner", daemon=True)
+
+	def __iter__(self):
+		"""
+		Start the walk and yield ScanEntry objects as files are discovered
+		"""
+		self.thread.start()
+		while self.continue_running:
+			try:
+				entry = self.queue.get(timeout=0.5)
+			except queue.Empty:
+				continue
+			if entry is _END_OF_SCAN:
+				break
+			yield entry
+
+	def stop(self):
+		"""
+		Stop the walk, files that are already queued are discarded
+		"""
+		self.continue_running = False
+
+	def progress(self, index):
+		"""
+		Progress string of the given file
+		:param index: 1 based index of the file in the scan stream
+		:return: progress string for logging
+		"""
+		if self.done:
+			return f"{index}/{self.discovered}"
+		return f"{index}/{self.discovered} discovered so far"
+
+	def _produce(self):
+		"""
+		Scanner thread body
+		"""
+		try:
+			if os.path.isdir(self.src):  # if the source is a directory find all the files
+				for entry in self.walk_tree(os.path.abspath(self.src)):
+					if not self._put(entry):
+						return
+			else:  # if the source is a file just process it
+				try:
+					self._put(ScanEntry.from_stat(self.src, os.stat(self.src)))
+				except OSError as e:
+					logging.warning(f"cannot stat {self.src}: {str(e)}")
+		finally:
+			self.done = True
+			logging.info(f"scan is complete, number of files discovered: {self.discovered}")
+			self._put(_END_OF_SCAN)
+
+	def _put(self, entry):
+		"""
+		Put an item in the queue, wait while the queue is full
+		:param entry: ScanEntry or end of scan marker
+		:return: False if the scan is stopped
+		"""
+		while self.continue_running:
+			try:
+				self.queue.put(entry, timeout=0.5)
+			except queue.Full:
+				continue
+			if entry is not _END_OF_SCAN:
+				self.discovered += 1
+			return True
+		return False
+
+	@staticmethod
+	def walk(top):
+		"""
+		Walk the directory tree with os.scandir, the order of the files is the same as os.walk
+		Symbolic links to directories are not followed. Every file is stat'ed once, files that cannot be stat'ed are
+		skipped.
+		:param top: absolute path of the root directory
+		:return: generator of ScanEntry
+		"""
+		stack = [top]
+		while stack:
+			directory = stack.pop()
+			dirs = []
+			try:
+				with os.scandir(directory) as it:
+					for entry in it:
+						try:
+							is_dir = entry.is_dir()
+						except OSError:
+							is_dir = False
+						if is_dir:
+							if not entry.is_symlink():
+								dirs.append(entry.path)
+							continue
+						try:
+							scan_entry = ScanEntry.from_stat(entry.path, entry.stat())
+						except OSError as e:
+							logging.warning(f"cannot stat {entry.path}: {str(e)}")
+							continue
+						yield scan_entry
+			except OSError as e:
+				logging.warning(f"cannot list directory {directory}: {str(e)}")
+				continue
+			stack.extend(reversed(dirs))  # visit sub directories in listing order
@@ -0,0 +1,194 @@
+import os
+import signal
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from glacier_rsync.compression import get_codec
+
+
+class Frame:
+	"""
+	An independent compressed frame of a seekable archive
+	"""
+
+	def __init__(self, frame_index, uncompressed_offset, uncompressed_size, compressed_offset, compressed_size):
+		"""
+		:param frame_index: position of the frame in the archive
+		:param uncompressed_offset: position of the frame data in the original file
+		:param uncompressed_size: size of the frame data in the original file
+		:param compressed_offset: position of the frame in the archive
+		:param compressed_size: size of the frame in the archive
+		"""
+		self.frame_index = frame_index
+		self.uncompressed_offset = uncompressed_offset
+		self.uncompressed_size = uncompressed_size
+		self.compressed_offset = compressed_offset
+		self.compressed_size = compressed_size
+
+
+class SeekableCompressor:
+	"""
+	Compress a file into independent frames of frame_size bytes of input
+	Frames are compressed by an executor, usually a process pool, so compression is not limited to a single core. Frames
+	are returned in order and the frame index is built while the output is read. The output is a valid stream of the
+	codec, it can also be decompressed as a whole.
+	"""
+
+	def __init__(self, f, frame_size, executor, window, codec_name, level):
+		"""
+		:param f: file object of the original file
+		:param frame_size: uncompressed size of a frame
+		:param executor: executor running compress_frame
+		:param window: maximum number of frames compressed at the same time for this file
+		:param codec_name: name of the codec, codec objects are looked up by name in the worker processes
+		:param level: compression level
+		"""
+		self.f = f
+		self.frame_size = frame_size
+		self.codec_name = codec_name
+		self.level = level
+		self.executor = executor
+		self.window = window
+		self.in_flight = deque()  # futures of tuple(uncompressed size, compressed frame)
+		self.eof = False
+		self.frames = []
+		self.uncompressed_offset = 0
+		self.compressed_offset = 0
+		self.current = memoryview(b"")
+
+	def readinto(self, buffer):
+		"""
+		Copy compressed data into the given buffer
+		:param buffer: writable bytes-like object
+		:return: number of bytes copied, 0 at the end of the stream
+		"""
+		if not self.current:
+			self._next_frame()
+		size = min(len(buffer), len(self.current))
+		buffer[:size] = self.current[:size]
+		self.current = self.current[size:]
+		return size
+
+	def _next_frame(self):
+		"""
+		Take the next compressed frame and keep the compression window full
+		"""
+		while not self.eof and len(self.in_flight) < self.window:
+			data = self.f.read(self.frame_size)
+			if not data:
+				self.eof = True
+				break
+			self.in_flight.append(self.executor.submit(compress_frame, data, self.codec_name, self.level))
+		if not self.in_flight:
+			return
+		uncompressed_size, frame = self.in_flight.popleft().result()
+		self.frames.append(Frame(
+			len(self.frames), self.uncompressed_offset, uncompressed_size, self.compressed_offset, len(frame)))
+		self.uncompressed_offset += uncompressed_size
+		self.compressed_offset += len(frame)
+		self.current = memoryview(frame)
+
+
+class FrameWriter:
+	"""
+	Decompress a seekable archive into a file, frames are decompressed in parallel
+	Compressed data is written in order like to a stream writer. Every complete frame is decompressed by the executor and
+	written to its position in the file, at most window frames are held in memory.
+	"""
+
+	def __init__(self, dst, frames, codec, executor, window, position=0):
+		"""
+		:param dst: file object of the restored file
+		:param frames: list of Frame of the archive in order
+		:param codec: Codec object of the archive
+		:param executor: thread pool decompressing the frames
+		:param window: maximum number of frames decompressed at the same time
+		:param position: position in the archive of the first written byte, frames starting before it are already
+			restored and the bytes up to the next frame are skipped
+		"""
+		self.dst = dst
+		self.frames = deque(frame for frame in frames if frame.compressed_offset >= position)
+		self.codec = codec
+		self.executor = executor
+		self.window = window
+		self.buffer = bytearray()
+		self.in_flight = set()
+		self.submitted = deque()  # tuple(Frame, future) in archive order, to find the completed frames
+		restored = [frame for frame in frames if frame.compressed_offset < position]
+		self.size = sum(frame.uncompressed_size for frame in restored)  # decompressed bytes, frames are contiguous
+		self.completed_offset = restored[-1].compressed_offset + restored[-1].compressed_size if restored else 0
+		self.skip = self.frames[0].compressed_offset - position if self.frames else 0
+
+	def write(self, data):
+		"""
+		:param data: next bytes of the compressed archive
+		"""
+		if self.skip:
+			skipped = min(self.skip, len(data))
+			data = data[skipped:]
+			self.skip -= skipped
+		self.buffer += data
+		while self.frames and len(self.buffer) >= self.frames[0].compressed_size:
+			frame = self.frames.popleft()
+			frame_data = bytes(self.buffer[:frame.compressed_size])
+			del self.buffer[:frame.compressed_size]
+			future = self.executor.submit(self._decompress_into, frame, frame_data)
+			self.in_flight.add(future)
+			self.submitted.append((frame, future))
+			if len(self.in_flight) >= self.window:
+				done, self.in_flight = wait(self.in_flight, return_when=FIRST_COMPLETED)
+				for finished in done:
+					self.size += finished.result()
+
+	def close(self):
+		"""
+		Wait for the remaining frames and move the file position to the end of the decompressed data
+		"""
+		done, self.in_flight = wait(self.in_flight)
+		for finished in done:
+			self.size += finished.result()
+		self.dst.seek(self.size)
+
+	def abort(self):
+		"""
+		Wait for the frames in progress without checking their results
+		"""
+		wait(self.in_flight)
+		self.in_flight = set()
+
+	def completed(self):
+		"""
+		:return: position in the archive, every frame starting before it is decompressed and written
+		"""
+		while self.submitted and self.submitted[0][1].done() and self.submitted[0][1].exception() is None:
+			frame, _ = self.submitted.popleft()
+			self.completed_offset = frame.compressed_offset + frame.compressed_size
+		return self.completed_offset
+
+	def _decompress_into(self, frame, data):
+		"""
+		:return: number of decompressed bytes written
+		"""
+		decompressed = self.codec.decompress(data, frame.uncompressed_size)
+		os.pwrite(self.dst.fileno(), decompressed, frame.uncompressed_offset)
+		return len(decompressed)
+
+
+def init_worker():
+	"""
+	Initializer of compression worker processes
+	ctrl+c is sent to the whole process group, workers ignore it so that files in progress can be completed.
+	"""
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def compress_frame(data, codec_name, level):
+	"""
+	Compress a frame, runs in a worker process
+	:param data: uncompressed bytes
+	:param codec_name: name of the codec
+	:param level: compression level
+	:return: tuple(uncompressed size, compressed frame)
+	"""
+	return len(data), get_codec(codec_name).compress(data, level)
+
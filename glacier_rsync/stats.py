@@ -0,0 +1,39 @@
+import logging
+import threading
+
+
+class RunStats:
+	"""
+	Thread safe counters of a single grsync run
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = {}
+
+	def increment(self, name, value=1):
+		"""
+		Increase a counter
+		:param name: counter name
+		:param value: amount to add
+		"""
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+	def get(self, name):
+		"""
+		:param name: counter name
+		:return: current value of the counter, 0 if it is never increased
+		"""
+		with self.lock:
+			return self.counters.get(name, 0)
+
+	def log_summary(self):
+		"""
+		Log all counters
+		"""
+		with self.lock:
+			counters = sorted(self.counters.items())
+		logging.info("run statistics:")
+		for name, value in counters:
+			logging.info(f"  {name}: {value}")
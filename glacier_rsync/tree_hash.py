@@ -0,0 +1,102 @@
+import binascii
+import hashlib
+
+TREE_HASH_CHUNK_SIZE = 1024 * 1024  # 1 MB, fixed by glacier
+
+
+class ChecksumMismatchError(Exception):
+	"""
+	Checksum calculated by glacier does not match the local checksum
+	"""
+
+
+def part_hashes(data):
+	"""
+	Calculate the tree hash and the linear sha256 of a part in a single pass
+	Hashing releases the GIL, so parts can be hashed in worker threads while other parts are uploaded.
+	:param data: bytes-like object
+	:return: tuple(tree hash hex digest, sha256 hex digest)
+	"""
+	view = memoryview(data)
+	linear = hashlib.sha256()
+	chunk_digests = []
+	for chunk_pos in range(0, len(view), TREE_HASH_CHUNK_SIZE):
+		chunk = view[chunk_pos: chunk_pos + TREE_HASH_CHUNK_SIZE]
+		linear.update(chunk)
+		chunk_digests.append(hashlib.sha256(chunk).digest())
+	return binascii.hexlify(_reduce(chunk_digests)).decode(), linear.hexdigest()
+
+
+def tree_hash(data):
+	"""
+	Calculate the tree hash of a part
+	:param data: bytes-like object
+	:return: tree hash hex digest
+	"""
+	view = memoryview(data)
+	return binascii.hexlify(_reduce([
+		hashlib.sha256(view[chunk_pos: chunk_pos + TREE_HASH_CHUNK_SIZE]).digest()
+		for chunk_pos in range(0, len(view), TREE_HASH_CHUNK_SIZE)
+	])).decode()
+
+
+def total_tree_hash(checksums):
+	"""
+	Combine tree hashes of consecutive parts into the tree hash of the archive
+	:param checksums: list of hex digests
+	:return: hex digest
+	"""
+	return binascii.hexlify(_reduce([binascii.unhexlify(checksum) for checksum in checksums])).decode()
+
+
+class TreeHasher:
+	"""
+	Calculate the tree hash of a stream fed in pieces of any size
+	"""
+
+	def __init__(self):
+		self.chunk_digests = []
+		self.pending = hashlib.sha256()  # hash of the incomplete last chunk
+		self.pending_size = 0
+
+	def update(self, data):
+		"""
+		:param data: next bytes-like object of the stream
+		"""
+		view = memoryview(data)
+		while view:
+			size = min(len(view), TREE_HASH_CHUNK_SIZE - self.pending_size)
+			self.pending.update(view[:size])
+			self.pending_size += size
+			view = view[size:]
+			if self.pending_size == TREE_HASH_CHUNK_SIZE:
+				self.chunk_digests.append(self.pending.digest())
+				self.pending = hashlib.sha256()
+				self.pending_size = 0
+
+	def hexdigest(self):
+		"""
+		:return: tree hash hex digest of the data fed so far
+		"""
+		digests = self.chunk_digests + [self.pending.digest()] if self.pending_size else self.chunk_digests
+		return binascii.hexlify(_reduce(digests)).decode()
+
+
+def _reduce(digests):
+	"""
+	Reduce a list of binary digests into the root of the hash tree
+	:param digests: list of binary digests
+	:return: binary root digest
+	"""
+	if len(digests) == 0:  # empty archive
+		return hashlib.sha256(b"").digest()
+	tree = digests
+	while len(tree) > 1:
+		parent = []
+		for i in range(0, len(tree), 2):
+			if i < len(tree) - 1:
+				parent.append(hashlib.sha256(tree[i] + tree[i + 1]).digest())
+			else:
+				parent.append(tree[i])
+		tree = parent
+	return tree[0]
@@ -0,0 +1,107 @@
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from glacier_rsync.scanner import ScanEntry
+
+ORDERED = "ordered"
+UNORDERED = "unordered"
+
+
+class ParallelWalker:
+	"""
+	Walk the directory tree with a thread pool, several directories are listed and their files stat'ed at the same time
+	On NFS or SMB every listing and stat is a network round trip, a single thread spends most of the walk waiting.
+	In ordered mode files are yielded in the same order as Scanner.walk. The sub directories of a directory are listed
+	in parallel while the files before them are consumed, so a deep and narrow tree is walked almost sequentially. In
+	unordered mode files are yielded as soon as their directory is listed and the workers are always busy.
+	"""
+
+	def __init__(self, workers, order=ORDERED):
+		"""
+		:param workers: number of threads listing directories
+		:param order: ORDERED or UNORDERED
+		"""
+		self.workers = workers
+		self.order = order
+
+	def walk(self, top):
+		"""
+		:param top: absolute path of the root directory
+		:return: generator of ScanEntry
+		"""
+		executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="grsync-walker")
+		try:
+			if self.order == ORDERED:
+				yield from self._walk_ordered(executor, top)
+			else:
+				yield from self._walk_unordered(executor, top)
+		finally:
+			executor.shutdown(wait=False)  # a stopped walk does not wait for the queued listings
+
+	def _walk_ordered(self, executor, top):
+		"""
+		Depth first walk, the listings of the directories on top of the stack run ahead of the consumer
+		At most twice the number of workers listings are in flight, the directory on top of the stack is always listed.
+		"""
+		stack = [top]  # paths of directories to list or futures of their listings
+		in_flight = 0
+		try:
+			while stack:
+				index = len(stack) - 1
+				while index >= 0 and (in_flight < self.workers * 2 or index == len(stack) - 1):
+					if not isinstance(stack[index], Future):
+						stack[index] = executor.submit(self._list, stack[index])
+						in_flight += 1
+					index -= 1
+				files, dirs = stack.pop().result()
+				in_flight -= 1
+				stack.extend(reversed(dirs))  # visit sub directories in listing order
+				yield from files
+		finally:
+			for entry in stack:
+				if isinstance(entry, Future):
+					entry.cancel()
+
+	def _walk_unordered(self, executor, top):
+		"""
+		Directories are listed in any order, at most twice the number of workers listings are in flight
+		"""
+		pending = [top]
+		in_flight = set()
+		while pending or in_flight:
+			while pending and len(in_flight) < self.workers * 2:
+				in_flight.add(executor.submit(self._list, pending.pop()))  # depth first keeps pending short
+			done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+			for future in done:
+				files, dirs = future.result()
+				pending.extend(reversed(dirs))
+				yield from files
+
+	@staticmethod
+	def _list(directory):
+		"""
+		List a directory and stat its files, symbolic links to directories are not followed
+		:return: tuple(list of ScanEntry, list of sub directory paths)
+		"""
+		files = []
+		dirs = []
+		try:
+			with os.scandir(directory) as it:
+				for entry in it:
+					try:
+						is_dir = entry.is_dir()
+					except OSError:
+						is_dir = False
+					if is_dir:
+						if not entry.is_symlink():
+							dirs.append(entry.path)
+						continue
+					try:
+						files.append(ScanEntry.from_stat(entry.path, entry.stat()))
+					except OSError as e:
+						logging.warning(f"cannot stat {entry.path}: {str(e)}")
+		except OSError as e:
+			logging.warning(f"cannot list directory {directory}: {str(e)}")
+			return files, []
+		return files, dirs
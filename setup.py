@@ -31,7 +31,7 @@ setup(
 	long_description_content_type="text/markdown",
 	author='Cagdas Bas',
 	author_email='cagdasbs@gmail.com',
-	packages=find_packages("."),
+	packages=find_packages(".", exclude=["tests", "tests.*"]),
 	include_package_data=True,
 	entry_points={
 		"console_scripts": [
@@ -40,7 +40,8 @@ setup(
 	},
 	install_requires=read_requirements('requirements.txt'),
 	extras_require={
-		'compression': ["zstandard"]
+		'compression': ["zstandard", "lz4"],
+		'dedup': ["xxhash"],
 	},
 	classifiers=[
 		'Development Status :: 5 - Production/Stable',
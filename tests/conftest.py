@@ -0,0 +1,82 @@
+import os
+
+import boto3
+import pytest
+
+from glacier_rsync.argparser import ArgParser, RestoreArgParser
+from glacier_rsync.backup_util import BackupUtil
+from glacier_rsync.restore_util import RestoreUtil
+from tests.glacier_stub import GlacierStub
+
+
+@pytest.fixture
+def glacier(monkeypatch):
+	"""
+	:return: GlacierStub returned by every boto3 client created in the test
+	"""
+	stub = GlacierStub()
+	monkeypatch.setattr(boto3, "client", lambda *args, **kwargs: stub)
+	return stub
+
+
+@pytest.fixture
+def db(tmp_path):
+	return str(tmp_path / "grsync.db")
+
+
+@pytest.fixture
+def src(tmp_path):
+	"""
+	:return: path of a source tree with a large compressible file, small files, an empty file and a duplicate
+	"""
+	root = tmp_path / "src"
+	(root / "docs" / "nested").mkdir(parents=True)
+	(root / "media").mkdir()
+	text = os.urandom(2560 * 1024).hex().encode()  # compresses to about half, still several parts of 1 MB
+	(root / "docs" / "large.txt").write_bytes(text)
+	for index in range(20):
+		(root / "docs" / "nested" / f"note{index}.txt").write_bytes(f"note {index} ".encode() * (index + 1))
+	(root / "docs" / "empty.txt").write_bytes(b"")
+	(root / "media" / "random.bin").write_bytes(os.urandom(1536 * 1024))
+	(root / "media" / "copy.txt").write_bytes(text)
+	return str(root)
+
+
+def backup_args(db, src, *options):
+	return ArgParser().get_args(["--vault", "vault", "--region", "region", "--db", db, *options, src])
+
+
+def run_backup(db, src, *options):
+	"""
+	:return: BackupUtil object after the backup
+	"""
+	util = BackupUtil(backup_args(db, src, *options))
+	util.backup()
+	return util
+
+
+def run_restore(db, dest, *options):
+	"""
+	:return: RestoreUtil object after the restore
+	"""
+	util = RestoreUtil(RestoreArgParser().get_args([
+		"--vault", "vault", "--region", "region", "--db", db, "--dest", dest, "--chunk-size", "1048576",
+		"--poll-interval", "1", *options]))
+	util.restore()
+	return util
+
+
+def assert_restored(src, dest):
+	"""
+	Compare the content and modification time of every file of the source tree with its restored copy
+	"""
+	count = 0
+	for root, _, names in os.walk(src):
+		for name in names:
+			path = os.path.join(root, name)
+			restored = os.path.join(dest, path.lstrip(os.sep))
+			with open(path, "rb") as original, open(restored, "rb") as copy:
+				assert original.read() == copy.read(), path
+			assert os.stat(path).st_mtime_ns == os.stat(restored).st_mtime_ns, path
+			count += 1
+	assert count > 0
@@ -0,0 +1,159 @@
+import threading
+import uuid
+
+from botocore.exceptions import ClientError
+
+from glacier_rsync.retrieval import is_tree_hash_aligned
+from glacier_rsync.tree_hash import TREE_HASH_CHUNK_SIZE, tree_hash
+
+
+class _Events:
+	"""
+	Event hooks of the client meta, handlers are only recorded
+	"""
+
+	def __init__(self):
+		self.handlers = []
+
+	def register_first(self, event_name, handler):
+		self.handlers.append((event_name, handler))
+
+	register = register_first
+
+
+class _Meta:
+	def __init__(self):
+		self.events = _Events()
+
+
+class _Body:
+	def __init__(self, data):
+		self.data = data
+
+	def read(self):
+		return self.data
+
+
+class GlacierStub:
+	"""
+	In memory glacier vault implementing the client calls used by grsync
+	Retrieval jobs complete immediately. Every call is counted in calls, failures can be injected by replacing a
+	method of an instance.
+	"""
+
+	def __init__(self):
+		self.meta = _Meta()
+		self.lock = threading.Lock()
+		self.calls = {}
+		self.uploads = {}  # upload id -> dict(part size, description, parts)
+		self.archives = {}  # archive id -> bytes
+		self.descriptions = {}  # archive id -> description
+		self.jobs = {}  # job id -> tuple(description, output)
+
+	def _count(self, name):
+		with self.lock:
+			self.calls[name] = self.calls.get(name, 0) + 1
+
+	def _store(self, data, description):
+		archive_id = uuid.uuid4().hex
+		with self.lock:
+			self.archives[archive_id] = data
+			self.descriptions[archive_id] = description
+		return {
+			"archiveId": archive_id,
+			"location": f"/vault/archives/{archive_id}",
+			"checksum": tree_hash(data),
+			"ResponseMetadata": {"HTTPHeaders": {"date": "Mon, 01 Jan 2024 00:00:00 GMT"}},
+		}
+
+	def upload_archive(self, vaultName, archiveDescription=None, body=None, checksum=None):
+		self._count("upload_archive")
+		data = body.read() if hasattr(body, "read") else bytes(body)
+		assert checksum is None or checksum == tree_hash(data)
+		return self._store(data, archiveDescription)
+
+	def initiate_multipart_upload(self, vaultName, partSize, archiveDescription=None):
+		self._count("initiate_multipart_upload")
+		upload_id = uuid.uuid4().hex
+		self.uploads[upload_id] = {"part_size": int(partSize), "description": archiveDescription, "parts": {}}
+		return {"uploadId": upload_id}
+
+	def upload_multipart_part(self, vaultName, uploadId, range, body, checksum=None):
+		self._count("upload_multipart_part")
+		data = body.read() if hasattr(body, "read") else bytes(body)
+		range_start, range_end = (int(pos) for pos in range.split()[1].split("/")[0].split("-"))
+		assert range_end + 1 - range_start == len(data)
+		assert checksum is None or checksum == tree_hash(data)
+		if uploadId not in self.uploads:
+			raise ClientError({"Error": {"Code": "ResourceNotFoundException"}}, "UploadMultipartPart")
+		self.uploads[uploadId]["parts"][range_start] = data
+		return {"checksum": tree_hash(data)}
+
+	def list_parts(self, vaultName, uploadId, marker=None):
+		self._count("list_parts")
+		if uploadId not in self.uploads:
+			raise ClientError({"Error": {"Code": "ResourceNotFoundException"}}, "ListParts")
+		upload = self.uploads[uploadId]
+		return {
+			"PartSizeInBytes": upload["part_size"],
+			"Parts": [
+				{"RangeInBytes": f"{start}-{start + len(data) - 1}", "SHA256TreeHash": tree_hash(data)}
+				for start, data in sorted(upload["parts"].items())
+			],
+		}
+
+	def abort_multipart_upload(self, vaultName, uploadId):
+		self._count("abort_multipart_upload")
+		self.uploads.pop(uploadId, None)
+
+	def complete_multipart_upload(self, vaultName, uploadId, archiveSize, checksum):
+		self._count("complete_multipart_upload")
+		upload = self.uploads.pop(uploadId)
+		data = b"".join(part for _, part in sorted(upload["parts"].items()))
+		assert len(data) == int(archiveSize)
+		assert checksum == tree_hash(data)
+		return self._store(data, upload["description"])
+
+	def delete_archive(self, vaultName, archiveId):
+		self._count("delete_archive")
+		self.archives.pop(archiveId)
+
+	def initiate_job(self, vaultName, jobParameters):
+		self._count("initiate_job")
+		archive_id = jobParameters["ArchiveId"]
+		data = self.archives[archive_id]
+		byte_range = jobParameters.get("RetrievalByteRange")
+		if byte_range:
+			range_start, range_end = (int(pos) for pos in byte_range.split("-"))
+			assert range_start % TREE_HASH_CHUNK_SIZE == 0
+			assert (range_end + 1) % TREE_HASH_CHUNK_SIZE == 0 or range_end + 1 == len(data)
+			data = data[range_start:range_end + 1]
+		job_id = uuid.uuid4().hex
+		self.jobs[job_id] = (
+			{
+				"JobId": job_id, "StatusCode": "Succeeded", "ArchiveId": archive_id,
+				"ArchiveSizeInBytes": len(self.archives[archive_id]), "SHA256TreeHash": tree_hash(data),
+			},
+			data,
+		)
+		return {"jobId": job_id}
+
+	def describe_job(self, vaultName, jobId):
+		self._count("describe_job")
+		if jobId not in self.jobs:
+			raise ClientError({"Error": {"Code": "ResourceNotFoundException"}}, "DescribeJob")
+		return dict(self.jobs[jobId][0])
+
+	def list_jobs(self, vaultName, completed=None, marker=None):
+		self._count("list_jobs")
+		return {"JobList": [dict(description) for description, _ in self.jobs.values()], "Marker": None}
+
+	def get_job_output(self, vaultName, jobId, range=None):
+		self._count("get_job_output")
+		description, data = self.jobs[jobId]
+		range_start, range_end = (int(pos) for pos in range.split("=")[1].split("-"))
+		chunk = data[range_start:range_end + 1]
+		response = {"body": _Body(chunk)}
+		if is_tree_hash_aligned(range_start, range_end, len(data)):
+			response["checksum"] = tree_hash(chunk)
+		return response
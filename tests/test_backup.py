@@ -0,0 +1,64 @@
+import os
+import sqlite3
+
+import pytest
+
+from glacier_rsync.backup_util import BackupUtil
+from tests.conftest import backup_args, run_backup
+
+
+@pytest.mark.parametrize("codec, level", [("zstd", 3), ("lz4", 0), ("xz", 6)])
+def test_default_level_of_codec(glacier, db, src, codec, level):
+	util = BackupUtil(backup_args(db, src, "--compress", codec))
+	try:
+		assert util.compress_level == level
+	finally:
+		util.close()
+
+
+def test_level_out_of_codec_range(db, src, capsys):
+	with pytest.raises(SystemExit):
+		backup_args(db, src, "--compress", "xz", "--compress-level", "15")
+	assert "xz compression level must be between 0 and 9" in capsys.readouterr().err
+
+
+def test_threads_ignored_by_codec_without_threads(glacier, db, src):
+	util = BackupUtil(backup_args(db, src, "--compress", "lz4", "--compress-threads", "2"))
+	try:
+		assert util.compress_threads == 0
+	finally:
+		util.close()
+
+
+def test_file_modified_during_upload(glacier, db, src, monkeypatch):
+	path = os.path.join(src, "docs", "large.txt")
+	upload_part = glacier.upload_multipart_part
+
+	def append_during_upload(**kwargs):
+		with open(path, "ab") as f:
+			f.write(b"appended")
+		return upload_part(**kwargs)
+
+	monkeypatch.setattr(glacier, "upload_multipart_part", append_during_upload)
+	util = run_backup(db, src, "--dedup", "true")
+	assert util.stats.counters["files_modified_during_backup"] == 1
+
+	conn = sqlite3.connect(db)
+	try:
+		rows = conn.execute("select archive_id, content_hash from sync_history where path=?", (path,)).fetchall()
+		recorded = {archive_id for archive_id, in conn.execute("select archive_id from sync_history")}
+	finally:
+		conn.close()
+	assert len(rows) == 1 and rows[0][1] is None  # recorded without the hashes of a torn archive
+	assert set(glacier.archives) <= recorded  # no archive is unknown to the catalog
+
+	monkeypatch.setattr(glacier, "upload_multipart_part", upload_part)
+	util = run_backup(db, src, "--dedup", "true")
+	assert util.stats.counters["files_backed_up"] == 1  # the modified file is uploaded again
+	assert util.stats.counters["files_skipped"] == 23
+
+
+def test_single_upload_buffers_are_reused(glacier, db, src):
+	util = run_backup(db, src, "--jobs", "2")
+	assert util.stats.counters["single_request_uploads"] > 3
+	assert util.whole_buffer_pool.allocated <= 3
@@ -0,0 +1,69 @@
+import os
+import sqlite3
+
+from glacier_rsync.catalog import MIGRATIONS, Catalog
+from glacier_rsync.tree_hash import tree_hash
+from tests.conftest import assert_restored, run_backup, run_restore
+
+
+def create_baseline_db(db, rows):
+	"""
+	Create a catalog with the schema of the first release, before schema versions
+	:param rows: list of tuple(path, file size, mtime, archive id, checksum, compression)
+	"""
+	conn = sqlite3.connect(db)
+	conn.execute(
+		"create table if not exists sync_history (id integer primary key, path text, file_size integer, "
+		"mtime float, archive_id text, location text, checksum text, compression text, timestamp text);")
+	conn.executemany(
+		"insert into sync_history (path, file_size, mtime, archive_id, location, checksum, compression, timestamp) "
+		"values (?, ?, ?, ?, '', ?, ?, '')",
+		rows)
+	conn.commit()
+	conn.close()
+
+
+def schema_version(db):
+	conn = sqlite3.connect(db)
+	try:
+		return conn.execute("select max(version) from schema_version").fetchone()[0]
+	finally:
+		conn.close()
+
+
+def test_migrate_empty_db(db):
+	Catalog(db).close()
+	assert schema_version(db) == len(MIGRATIONS)
+	Catalog(db).close()  # reopening does not migrate again
+	assert schema_version(db) == len(MIGRATIONS)
+
+
+def test_migrate_baseline_db(glacier, db, src, tmp_path):
+	path = os.path.join(src, "media", "random.bin")
+	with open(path, "rb") as f:
+		data = f.read()
+	stat = os.stat(path)
+	glacier.archives["legacy"] = data
+	create_baseline_db(db, [(path, stat.st_size, stat.st_mtime, "legacy", tree_hash(data), "plain")])
+
+	util = run_backup(db, src)
+	assert schema_version(db) == len(MIGRATIONS)
+	assert util.stats.counters["files_skipped"] == 1  # the legacy row matches with its float mtime
+	assert util.stats.counters["files_backed_up"] == 23
+	conn = sqlite3.connect(db)
+	assert conn.execute("select mtime_ns from sync_history where archive_id='legacy'").fetchone()[0] == stat.st_mtime_ns
+	conn.close()
+
+	run_restore(db, str(tmp_path / "restored"))
+	assert_restored(src, str(tmp_path / "restored"))
+
+
+def test_legacy_row_of_modified_file(db, src):
+	path = os.path.join(src, "media", "random.bin")
+	stat = os.stat(path)
+	create_baseline_db(db, [(path, stat.st_size, stat.st_mtime - 1, "legacy", "", "plain")])
+	catalog = Catalog(db)
+	try:
+		assert not catalog.is_backed_up(path, stat.st_size, stat.st_mtime_ns, stat.st_mtime)
+	finally:
+		catalog.close()
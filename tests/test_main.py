@@ -0,0 +1,48 @@
+import os
+import threading
+
+from glacier_rsync import __main__ as grsync_main
+from glacier_rsync.backup_util import BackupUtil
+from tests.conftest import backup_args
+
+
+class ForceExit(Exception):
+	pass
+
+
+def test_force_stop_while_the_catalog_is_locked(glacier, db, src, monkeypatch):
+	util = BackupUtil(backup_args(db, src))
+
+	def exit_(code):
+		raise ForceExit()
+
+	monkeypatch.setattr(os, "_exit", exit_)
+	handler = grsync_main.stop_handler(util)
+	result = []
+
+	def interrupt_load_cache():
+		with util.catalog.lock:  # the main thread is interrupted in load_cache
+			for _ in range(grsync_main.FORCE_STOP_LIMIT - 1):
+				handler(None, None)
+			try:
+				handler(None, None)
+			except ForceExit:
+				result.append("exited")
+
+	thread = threading.Thread(target=interrupt_load_cache, daemon=True)
+	thread.start()
+	thread.join(timeout=10)
+	assert result == ["exited"]
+	assert not util.continue_running
+	util.close()
+
+
+def test_backup_of_a_folder_named_restore(glacier, db, tmp_path, monkeypatch):
+	os.makedirs(tmp_path / "restore")
+	(tmp_path / "restore" / "file.txt").write_bytes(b"data")
+	monkeypatch.chdir(tmp_path)
+	monkeypatch.setattr(grsync_main.signal, "signal", lambda sig, handler: None)
+	monkeypatch.setattr(
+		grsync_main.sys, "argv", ["grsync", "./restore", "--vault", "vault", "--region", "region", "--db", db])
+	grsync_main.main()
+	assert len(glacier.archives) == 1
@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from glacier_rsync.argparser import RestoreArgParser
+from glacier_rsync.restore_util import RestoreUtil
+from tests.conftest import assert_restored, run_backup, run_restore
+
+
+class Crash(Exception):
+	pass
+
+
+@pytest.mark.parametrize("options", [[], ["--compress", "zstd", "--compress-probe-size", "0"]], ids=["plain", "zstd"])
+def test_resume_multipart_upload(glacier, db, src, tmp_path, monkeypatch, options):
+	os.remove(os.path.join(src, "media", "copy.txt"))
+	upload_part = glacier.upload_multipart_part
+	uploaded = []
+
+	def crash_on_third_part(**kwargs):
+		if len(uploaded) == 2:
+			raise Crash()
+		uploaded.append(kwargs["range"])
+		return upload_part(**kwargs)
+
+	monkeypatch.setattr(glacier, "upload_multipart_part", crash_on_third_part)
+	with pytest.raises(Crash):
+		run_backup(db, src, *options)
+	assert len(glacier.uploads) == 1
+
+	monkeypatch.setattr(glacier, "upload_multipart_part", upload_part)
+	run_backup(db, src, *options)
+	assert glacier.calls["list_parts"] == 1
+	assert glacier.calls["initiate_multipart_upload"] == 2  # random.bin starts after the crash of large.txt
+	assert not glacier.uploads
+	run_restore(db, str(tmp_path / "restored"))
+	assert_restored(src, str(tmp_path / "restored"))
+
+
+def test_changed_settings_abort_the_upload(glacier, db, src, monkeypatch):
+	upload_part = glacier.upload_multipart_part
+	count = [0]
+
+	def crash_on_third_part(**kwargs):
+		count[0] += 1
+		if count[0] == 3:
+			raise Crash()
+		return upload_part(**kwargs)
+
+	monkeypatch.setattr(glacier, "upload_multipart_part", crash_on_third_part)
+	with pytest.raises(Crash):
+		run_backup(db, src, "--compress", "zstd", "--compress-probe-size", "0", "--compress-level", "1")
+	monkeypatch.setattr(glacier, "upload_multipart_part", upload_part)
+	run_backup(db, src, "--compress", "zstd", "--compress-probe-size", "0", "--compress-level", "5")
+	assert glacier.calls["abort_multipart_upload"] == 1
+	assert "list_parts" not in glacier.calls
+
+
+def test_resume_restore(glacier, db, src, tmp_path, monkeypatch):
+	run_backup(db, src, "--compress", "zstd", "--frame-size", "262144", "--compress-probe-size", "0")
+	get_job_output = glacier.get_job_output
+	dest = str(tmp_path / "restored")
+	util = None
+	downloads = [0]
+
+	def stop_after_two_ranges(**kwargs):
+		downloads[0] += 1
+		if downloads[0] == 2:
+			util.stop()
+		return get_job_output(**kwargs)
+
+	monkeypatch.setattr(glacier, "get_job_output", stop_after_two_ranges)
+	util = RestoreUtil(RestoreArgParser().get_args([
+		"--vault", "vault", "--region", "region", "--db", db, "--dest", dest, "--chunk-size", "1048576",
+		"--poll-interval", "1", "--download-concurrency", "1"]))
+	util.restore()
+	first_run = downloads[0]
+
+	monkeypatch.setattr(glacier, "get_job_output", get_job_output)
+	run_restore(db, dest)
+	assert glacier.calls["initiate_job"] == 24  # the jobs of the first run are reused
+	assert first_run == 2
+	ranges = sum(-(-len(data) // 1048576) or 1 for data in glacier.archives.values())
+	assert glacier.calls["get_job_output"] <= ranges + 1  # at most the range in progress is downloaded again
+	assert_restored(src, dest)
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from glacier_rsync.retrieval import aligned_range, is_tree_hash_aligned
+from tests.conftest import assert_restored, run_backup, run_restore
+
+MB = 1024 * 1024
+
+
+@pytest.mark.parametrize("offset, length, archive_size, expected", [
+	(0, 10, 5 * MB, (0, MB - 1)),
+	(MB - 1, 2, 5 * MB, (0, 2 * MB - 1)),
+	(3 * MB + 5, 0, 5 * MB, (3 * MB, 4 * MB - 1)),
+	(4 * MB + 5, 100, 4 * MB + 200, (4 * MB, 4 * MB + 199)),
+])
+def test_aligned_range(offset, length, archive_size, expected):
+	assert aligned_range(offset, length, archive_size) == expected
+
+
+@pytest.mark.parametrize("start, end, archive_size, expected", [
+	(0, 5 * MB - 1, 5 * MB, True),  # the whole archive
+	(0, MB - 1, 5 * MB, True),
+	(MB, 2 * MB - 1, 5 * MB, True),
+	(2 * MB, 4 * MB - 1, 5 * MB, True),
+	(MB, 3 * MB - 1, 5 * MB, False),  # 2 MB starting at an odd megabyte
+	(0, 3 * MB - 1, 5 * MB, False),
+	(4 * MB, 5 * MB - 1 - 10, 5 * MB - 10, True),  # truncated at the end of the archive
+	(5, MB + 4, 5 * MB, False),
+])
+def test_is_tree_hash_aligned(start, end, archive_size, expected):
+	assert is_tree_hash_aligned(start, end, archive_size) == expected
+
+
+def test_corrupt_range_is_downloaded_again(glacier, db, src, tmp_path, monkeypatch):
+	os.remove(os.path.join(src, "media", "copy.txt"))
+	run_backup(db, src)
+	get_job_output = glacier.get_job_output
+	corrupted = []
+
+	def corrupt_first_range(**kwargs):
+		response = get_job_output(**kwargs)
+		if not corrupted and kwargs["range"].startswith("bytes=0-") and len(response["body"].data) > 1000:
+			corrupted.append(kwargs["jobId"])
+			response["body"].data = b"x" + response["body"].data[1:]
+		return response
+
+	monkeypatch.setattr(glacier, "get_job_output", corrupt_first_range)
+	dest = str(tmp_path / "restored")
+	util = run_restore(dest=dest, db=db)
+	assert util.stats.counters["files_failed"] == 1
+	run_restore(db, dest)
+	assert_restored(src, dest)
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from tests.conftest import assert_restored, run_backup, run_restore
+
+
+@pytest.mark.parametrize("options", [
+	[],
+	["--compress", "zstd"],
+	["--compress", "zstd-long"],
+	["--compress", "lz4"],
+	["--compress", "xz", "--compress-level", "0"],
+	["--compress", "zstd", "--frame-size", "262144", "--compress-workers", "2"],
+	["--compress", "zstd", "--compress-threads", "2"],
+	["--part-concurrency", "3", "--jobs", "2"],
+	["--single-upload-threshold", "0"],
+], ids=["plain", "zstd", "zstd-long", "lz4", "xz", "frames", "threads", "concurrency", "multipart-only"])
+def test_round_trip(glacier, db, src, tmp_path, options):
+	run_backup(db, src, "--compress-probe-size", "0", *options)
+	run_restore(db, str(tmp_path / "restored"))
+	assert_restored(src, str(tmp_path / "restored"))
+
+
+def test_round_trip_packing(glacier, db, src, tmp_path):
+	util = run_backup(db, src, "--pack-threshold", "4096", "--compress", "zstd")
+	assert util.stats.counters["files_packed"] == 21  # the notes and the empty file
+	run_restore(db, str(tmp_path / "restored"))
+	assert_restored(src, str(tmp_path / "restored"))
+
+
+def test_round_trip_dictionary(glacier, db, src, tmp_path):
+	run_backup(db, src, "--compress", "zstd", "--dictionary-size", "4096", "--dictionary-max-file-size", "4096")
+	run_restore(db, str(tmp_path / "restored"))
+	assert_restored(src, str(tmp_path / "restored"))
+
+
+def test_round_trip_dedup(glacier, db, src, tmp_path):
+	util = run_backup(db, src, "--dedup", "true", "--compress", "zstd")
+	assert util.stats.counters["files_deduplicated"] == 1  # media/copy.txt has the content of docs/large.txt
+	assert len(glacier.archives) == 23
+	run_restore(db, str(tmp_path / "restored"))
+	assert_restored(src, str(tmp_path / "restored"))
+
+
+def test_second_run_uploads_nothing(glacier, db, src):
+	run_backup(db, src)
+	uploads = dict(glacier.calls)
+	util = run_backup(db, src)
+	assert glacier.calls == uploads
+	assert util.stats.counters["files_skipped"] == 24
+
+
+def test_trust_dir_mtime(glacier, db, src, tmp_path):
+	for root, _, _ in os.walk(src):  # directories modified right before their listing are listed again
+		os.utime(root, ns=(0, 0))
+	run_backup(db, src, "--trust-dir-mtime", "true")
+	uploads = dict(glacier.calls)
+	util = run_backup(db, src, "--trust-dir-mtime", "true")
+	assert glacier.calls == uploads
+	assert util.stats.counters["directories_not_listed"] == 4
+	assert util.stats.counters["files_trusted"] == 24
+
+	(tmp_path / "src" / "docs" / "added.txt").write_bytes(b"added")
+	util = run_backup(db, src, "--trust-dir-mtime", "true")
+	assert util.stats.counters["files_backed_up"] == 1
+	run_restore(db, str(tmp_path / "restored"))
+	assert_restored(src, str(tmp_path / "restored"))
+
+
+def test_restore_path(glacier, db, src, tmp_path):
+	run_backup(db, src)
+	dest = tmp_path / "restored"
+	run_restore(db, str(dest), src + "/docs/nested")
+	restored = [path for path in dest.rglob("*") if path.is_file() and ".grsync-restore" not in path.parts]
+	assert len(restored) == 20
+	assert all("nested" in path.parts for path in restored)